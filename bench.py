@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+import cv2
+import numpy as np
+from telebot import apihelper
+import config
+
+# Нагрузочные сценарии против поддельного Telegram: запросы перехватываются
+# на уровне транспорта telebot (CUSTOM_REQUEST_SENDER), поэтому обработчики
+# из bot.py работают без изменений. Результат — JSON в stdout или в файл
+config.API_TOKEN = config.API_TOKEN or '0:bench'
+config.API_URL = None
+import bot
+from broadcast import Broadcaster
+
+class FakeResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self.reason = 'OK' if status_code == 200 else 'Too Many Requests'
+        self._payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self._payload
+
+class FakeTelegram:
+    # Записывает вызовы, имитирует задержку сети и, если задано, отвечает 429
+    # на каждый throttle_every-й запрос
+    def __init__(self, latency=0.0, throttle_every=0, retry_after=1):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.log = []
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        name = url.rsplit('/', 1)[-1]
+        params = params or {}
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self._count += 1
+            count = self._count
+            if self.throttle_every and count % self.throttle_every == 0:
+                self.calls['429'] += 1
+                return FakeResponse(429, {'ok': False, 'error_code': 429,
+                                          'description': f'Too Many Requests: retry after {self.retry_after}',
+                                          'parameters': {'retry_after': self.retry_after}})
+            self.calls[name] += 1
+            self.log.append((name, params.get('chat_id'), time.perf_counter()))
+
+        message = {'message_id': count, 'date': 0,
+                   'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'}}
+        if name == 'sendPhoto':
+            message['photo'] = [{'file_id': f'file_{count}', 'file_unique_id': f'u{count}',
+                                 'width': 1, 'height': 1}]
+        result = [message] if name == 'sendMediaGroup' else message
+        return FakeResponse(200, {'ok': True, 'result': result})
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.log.clear()
+
+def summarize(name, latencies, elapsed, count, **extra):
+    latencies = sorted(latencies)
+    result = {
+        'scenario': name,
+        'count': count,
+        'elapsed': round(elapsed, 4),
+        'throughput': round(count / elapsed, 2) if elapsed else None,
+        'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 3) if latencies else None,
+        'p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 3) if latencies else None,
+    }
+    result.update(extra)
+    return result
+
+def fake_call(user_id, data):
+    return SimpleNamespace(data=data, message=SimpleNamespace(chat=SimpleNamespace(id=user_id)))
+
+def fake_message(user_id, text=''):
+    return SimpleNamespace(text=text, chat=SimpleNamespace(id=user_id),
+                           from_user=SimpleNamespace(username=f'user{user_id}'))
+
+def make_images(count, size=640):
+    os.makedirs('img', exist_ok=True)
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        image = rng.integers(0, 255, (size // 8, size // 8, 3), dtype=np.uint8)
+        image = cv2.resize(image, (size, size), interpolation=cv2.INTER_LINEAR)
+        cv2.imwrite(f'img/bench_{i}.jpg', image)
+
+class Environment:
+    # Свежая БД и набор картинок на каждый сценарий. Рабочий каталог общий на
+    # весь прогон: процессы image_pool запоминают его при запуске
+    def __enter__(self):
+        for path in ('img', 'hidden_img'):
+            shutil.rmtree(path, ignore_errors=True)
+        for path in ('bench.db', 'bench.db-wal', 'bench.db-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        return self
+
+    def start(self, users, images):
+        make_images(images)
+        bot.init()
+        conn = bot.manager.connect()
+        with conn:
+            conn.executemany('INSERT INTO users (user_id, user_name, bonus_balance, is_admin) VALUES (?, ?, 0, 0)',
+                             [(i, f'user{i}') for i in range(1, users + 1)])
+        bot.manager.add_prize([(x,) for x in sorted(os.listdir('img'))])
+        return bot.manager
+
+    def __exit__(self, *exc):
+        if bot.journal is not None:
+            bot.journal.stop()
+        if bot.manager is not None:
+            bot.manager.close()
+
+def bench_broadcast(telegram, users):
+    with Environment() as env:
+        env.start(users, 1)
+        telegram.reset()
+        started = time.perf_counter()
+        bot.send_message()
+        enqueued = time.perf_counter() - started
+        while bot.drain_outbox():
+            pass
+        elapsed = time.perf_counter() - started
+        latencies = [t - started for name, chat_id, t in telegram.log if name == 'sendPhoto']
+        return summarize('broadcast', latencies, elapsed, len(latencies),
+                         users=users, enqueue_s=round(enqueued, 4), calls=dict(telegram.calls))
+
+def bench_click_storm(telegram, clicks):
+    with Environment() as env:
+        env.start(clicks, 1)
+        bot.send_message()
+        prize_id = bot._last_prize_id
+        telegram.reset()
+        latencies = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(clicks)
+
+        def click(user_id):
+            barrier.wait()
+            t0 = time.perf_counter()
+            bot.callback_query(fake_call(user_id, str(prize_id)))
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+        threads = [threading.Thread(target=click, args=(i,)) for i in range(1, clicks + 1)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        return summarize('click_storm', latencies, elapsed, clicks,
+                         winners=bot.manager.get_winners_count(prize_id), calls=dict(telegram.calls))
+
+def bench_get_my_score(telegram, images, repeats):
+    with Environment() as env:
+        env.start(1, images)
+        for prize_id in range(1, images + 1, 3):
+            bot.manager.claim_prize(1, prize_id, max_winners=1)
+        telegram.reset()
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            bot.handle_get_my_score(fake_message(1))
+            latencies.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - started
+        return summarize('get_my_score', latencies, elapsed, repeats, images=images,
+                         cold_ms=round(latencies[0] * 1000, 3), calls=dict(telegram.calls))
+
+def bench_rating(telegram, winners, repeats):
+    with Environment() as env:
+        users = max(1, winners // 10)
+        manager = env.start(users, 1)
+        conn = manager.connect()
+        with conn:
+            conn.executemany('INSERT INTO winners (user_id, prize_id, win_time) VALUES (?, ?, ?)',
+                             [(i % users + 1, i + 1000, '2024-01-01 00:00:00') for i in range(winners)])
+            conn.execute('''UPDATE users SET win_count = (
+                            SELECT COUNT(*) FROM winners WHERE winners.user_id = users.user_id)''')
+        telegram.reset()
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(repeats):
+            manager._invalidate_rating()
+            t0 = time.perf_counter()
+            bot.handle_rating(fake_message(1))
+            latencies.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - started
+        return summarize('rating', latencies, elapsed, repeats, winners=winners, calls=dict(telegram.calls))
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочные сценарии бота с поддельным Telegram')
+    parser.add_argument('--scenario', choices=['all', 'broadcast', 'clicks', 'score', 'rating'], default='all')
+    parser.add_argument('--users', type=int, default=1000, help='получателей рассылки лота')
+    parser.add_argument('--clicks', type=int, default=200, help='одновременных нажатий "Получить!"')
+    parser.add_argument('--images', type=int, default=100, help='картинок в каталоге для /get_my_score')
+    parser.add_argument('--winners', type=int, default=100000, help='строк в winners для /rating')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа Telegram, мс')
+    parser.add_argument('--throttle-every', type=int, default=0, help='отвечать 429 на каждый N-й запрос')
+    parser.add_argument('--rate', type=float, default=1000, help='лимит рассылки, сообщений в секунду')
+    parser.add_argument('--output', help='файл для JSON с результатами')
+    args = parser.parse_args(argv)
+
+    telegram = FakeTelegram(latency=args.latency / 1000, throttle_every=args.throttle_every)
+    apihelper.CUSTOM_REQUEST_SENDER = telegram
+    bot.broadcaster = Broadcaster(rate=args.rate, chat_interval=0)
+
+    scenarios = {
+        'broadcast': lambda: bench_broadcast(telegram, args.users),
+        'clicks': lambda: bench_click_storm(telegram, args.clicks),
+        'score': lambda: bench_get_my_score(telegram, args.images, args.repeats),
+        'rating': lambda: bench_rating(telegram, args.winners, args.repeats),
+    }
+    selected = scenarios if args.scenario == 'all' else {args.scenario: scenarios[args.scenario]}
+
+    commit = current_commit()
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='auction_bench_')
+    os.chdir(workdir)
+    bot.BASE_DIR = workdir
+    bot.DATABASE = 'bench.db'
+    results = []
+    try:
+        for run in selected.values():
+            results.append(run())
+    finally:
+        bot.broadcaster.shutdown()
+        bot.background.shutdown()
+        bot.image_pool.shutdown()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = json.dumps({'commit': commit, 'results': results}, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    print(report)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,10 +1,19 @@
+import io
 import os
 from telebot import TeleBot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException, ApiHTTPException
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from logic import *
-import schedule
+from broadcast import Broadcaster, retry_after
+from scheduler import Scheduler
+import metrics
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
 import threading
 import time
+import uuid
 from config import *
 import cv2
 import numpy as np
@@ -13,8 +22,16 @@ from math import sqrt, ceil, floor
 bot = TeleBot(API_TOKEN)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+manager = None
 _last_prize_id = None
 _last_img = None
+journal = None
+broadcaster = Broadcaster()
+image_pool = ProcessPoolExecutor(IMAGE_WORKERS, mp_context=get_context('spawn'))
+background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='background')
+files = ImageCache()
+collages = CollageCache(files=files)
+scheduler = Scheduler()
 
 def gen_markup(id, is_re_auction=False):
     markup = InlineKeyboardMarkup()
@@ -25,62 +42,137 @@ def gen_markup(id, is_re_auction=False):
         markup.add(InlineKeyboardButton("Получить!", callback_data=str(id)))
     return markup
 
-@bot.callback_query_handler(func=lambda call: True)
+def as_upload(data):
+    # telebot пишет параметры запроса в отладочный лог, форматируя их даже при
+    # выключенном DEBUG: repr больших bytes дороже самой отправки, у BytesIO он короткий
+    return io.BytesIO(data) if isinstance(data, bytes) else data
+
+def send_prize_photo(chat_id, img, hidden=False, **kwargs):
+    variant = 'hidden' if hidden else 'original'
+    file_id = manager.get_file_id(img, variant)
+    if file_id:
+        try:
+            return bot.send_photo(chat_id, file_id, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code != 400 or 'file' not in str(e.description).lower():
+                raise
+            # file_id больше не принимается — загружаем файл заново
+    
+    if hidden:
+        photo_path = os.path.join(BASE_DIR, 'hidden_img', img)
+    else:
+        # Уменьшенная версия есть, только если она легче оригинала
+        photo_path = os.path.join(BASE_DIR, 'display_img', img)
+        if not os.path.exists(photo_path):
+            photo_path = os.path.join(BASE_DIR, 'img', img)
+    msg = bot.send_photo(chat_id, as_upload(files.read(photo_path)), **kwargs)
+    manager.set_file_id(img, variant, msg.photo[-1].file_id)
+    return msg
+
+def deliver_outbox_message(row, sent_ids):
+    message_id, chat_id, img, caption, prize_id, is_re_auction, attempts = row
+    try:
+        send_prize_photo(chat_id, img, hidden=True, caption=caption,
+                         reply_markup=gen_markup(id=prize_id, is_re_auction=bool(is_re_auction)))
+    except Exception as e:
+        if retry_after(e) is not None:
+            raise
+        code = getattr(e, 'error_code', None)
+        unreachable = code == 403 or (code == 400 and 'chat not found' in str(e))
+        if unreachable:
+            # Чат недоступен навсегда — исключаем его из следующих рассылок
+            manager.mark_blocked(chat_id)
+        if unreachable or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+            manager.dead_letter_outbox(message_id, str(e))
+        else:
+            manager.retry_outbox(message_id, str(e), OUTBOX_BACKOFF * 2 ** attempts)
+        raise
+    sent_ids.append(message_id)
+
+def drain_outbox():
+    rows = manager.fetch_outbox(OUTBOX_BATCH)
+    if not rows:
+        return 0
+    
+    # Для картинки без file_id первое сообщение уходит отдельно и загружает файл
+    first, rest, uploaded = [], [], {}
+    for row in rows:
+        img = row[2]
+        if img not in uploaded:
+            uploaded[img] = manager.get_file_id(img, 'hidden') is not None
+            if not uploaded[img]:
+                first.append(row)
+                continue
+        rest.append(row)
+    
+    sent_ids = []
+    broadcaster.run(first + rest, lambda row: deliver_outbox_message(row, sent_ids),
+                    name='outbox', prime=len(first), key=lambda row: row[1])
+    manager.ack_outbox(sent_ids)
+    return len(rows)
+
+def drain_outbox_job():
+    while drain_outbox():
+        pass
+
+def prune_outbox_job():
+    pruned = manager.prune_outbox()
+    if pruned:
+        logging.info('pruned %d dead outbox messages', pruned)
+
+@bot.callback_query_handler(func=lambda call: not call.data.startswith('re_auction_'))
 def callback_query(call):
     user_id = call.message.chat.id
     
     if call.data.startswith('re_'):
         prize_id = int(call.data.replace('re_', ''))
         
-        active_auctions = manager.get_active_re_auctions()
-        active_ids = [a[0] for a in active_auctions]
+        auction = manager.get_re_auction(prize_id)
         
-        if prize_id not in active_ids:
+        if auction is None:
             bot.send_message(user_id, "Этот аукцион уже закончился!")
             return
         
-        bonus_cost = None
-        for auction in active_auctions:
-            if auction[0] == prize_id:
-                bonus_cost = auction[4]
-                break
+        bonus_cost = auction[4]
         
-        user_bonus = manager.get_user_bonus(user_id)
+        status, img = manager.claim_prize(user_id, prize_id, max_winners=1, bonus_cost=bonus_cost)
         
-        if user_bonus < bonus_cost:
+        if status == CLAIM_WON:
+            collages.invalidate(user_id)
+            send_prize_photo(user_id, img, 
+                             caption=f"🎉 Поздравляем! Ты получил картинку за {bonus_cost} бонусов!")
+        elif status == CLAIM_ALREADY_WON:
+            bot.send_message(user_id, 'Ты уже получил эту картинку!')
+        elif status == CLAIM_NO_BONUS:
+            user_bonus = manager.get_user_bonus(user_id)
             bot.send_message(user_id, f"❌ Недостаточно бонусов! Нужно: {bonus_cost}, у тебя: {user_bonus}")
-            return
-        
-        if manager.get_winners_count(prize_id) < 1:
-            if manager.spend_bonus(user_id, bonus_cost):
-                res = manager.add_winner(user_id, prize_id)
-                if res:
-                    img = manager.get_prize_img(prize_id)
-                    photo_path = os.path.join(BASE_DIR, 'img', img)
-                    with open(photo_path, 'rb') as photo:
-                        bot.send_photo(user_id, photo, 
-                                     caption=f"🎉 Поздравляем! Ты получил картинку за {bonus_cost} бонусов!")
-                else:
-                    bot.send_message(user_id, 'Ты уже получил эту картинку!')
-            else:
-                bot.send_message(user_id, "Ошибка при списании бонусов")
         else:
             bot.send_message(user_id, "К сожалению, картинку уже кто-то получил!")
     
     else:
         prize_id = int(call.data) if call.data.isdigit() else call.data
         
-        if manager.get_winners_count(prize_id) < int(manager.get_setting('winners_per_prize')):
-            res = manager.add_winner(user_id, prize_id)
-            if res:
-                img = manager.get_prize_img(prize_id)
-                photo_path = os.path.join(BASE_DIR, 'img', img)
-                bonus = manager.get_setting('bonus_per_win')
-                with open(photo_path, 'rb') as photo:
-                    bot.send_photo(user_id, photo, 
-                                 caption=f"Поздравляем! Ты получил картинку! +{bonus} бонусов! 💰")
-            else:
-                bot.send_message(user_id, 'Ты уже получил картинку!')
+        status, img, durable = journal.claim(user_id, prize_id)
+        # Оригинал отправляется только после записи выигрыша в БД; если выигрыш
+        # уже был записан мимо журнала, это повторное нажатие
+        if status == CLAIM_WON:
+            try:
+                recorded = durable.result()
+            except Exception:
+                # Журнал уже освободил место — пользователь может нажать ещё раз
+                logging.exception('failed to record win of %s for prize %s', user_id, prize_id)
+                bot.send_message(user_id, "❌ Не удалось записать выигрыш, попробуй нажать ещё раз")
+                return
+            if not recorded:
+                status = CLAIM_ALREADY_WON
+        
+        if status == CLAIM_WON:
+            collages.invalidate(user_id)
+            bonus = manager.get_setting('bonus_per_win')
+            send_prize_photo(user_id, img, 
+                             caption=f"Поздравляем! Ты получил картинку! +{bonus} бонусов! 💰")
+        elif status == CLAIM_ALREADY_WON:
+            bot.send_message(user_id, 'Ты уже получил картинку!')
         else:
             markup = InlineKeyboardMarkup()
             markup.add(InlineKeyboardButton("🔄 Повторный аукцион за бонусы", 
@@ -105,21 +197,30 @@ def handle_re_auction_request(call):
         img = manager.get_prize_img(prize_id)
         bonus_cost = manager.get_setting('re_auction_bonus_cost')
         
-        users = manager.get_users()
-        for uid in users:
-            with open(f'hidden_img/{img}', 'rb') as photo:
-                bot.send_photo(uid, photo, 
-                             caption=f"🔄 ПОВТОРНЫЙ АУКЦИОН!\n"
-                                    f"Стоимость участия: {bonus_cost} бонусов 💰\n"
-                                    f"Только один победитель!",
-                             reply_markup=gen_markup(id=new_prize_id, is_re_auction=True))
+        caption = (f"🔄 ПОВТОРНЫЙ АУКЦИОН!\n"
+                   f"Стоимость участия: {bonus_cost} бонусов 💰\n"
+                   f"Только один победитель!")
+        # Рассылаем только тем, кому хватает бонусов, чтобы участвовать
+        eligible = 0
+        for users in manager.iter_eligible_users(bonus_cost):
+            manager.enqueue_messages(users, img, caption, new_prize_id, is_re_auction=True)
+            eligible += len(users)
+        total = len(manager.get_user_registry())
+        logging.info('re_auction %s: %d of %d users eligible, %d sends saved',
+                     new_prize_id, eligible, total, total - eligible)
+        metrics.REAUCTION_SENDS_SAVED.inc(max(total - eligible, 0))
         
-        bot.send_message(user_id, "✅ Повторный аукцион создан и разослан всем пользователям!")
+        schedule_re_auction_expiry()
+        bot.send_message(user_id, f"✅ Повторный аукцион создан и разослан {eligible} из {total} пользователей "
+                                  f"(у остальных не хватает бонусов)")
     else:
         bot.send_message(user_id, "❌ Не удалось создать повторный аукцион")
 
 def send_message():
     global _last_prize_id, _last_img
+    while manager.get_outbox_pending_count() > OUTBOX_MAX_PENDING:
+        time.sleep(1)
+    
     prize = manager.get_random_prize()
     if prize is None:
         manager.reset_used_prizes()
@@ -128,32 +229,51 @@ def send_message():
             return
             
     prize_id, img = prize[:2]
+    journal.start(prize_id)
     _last_prize_id, _last_img = prize_id, img
     manager.mark_prize_used(prize_id)
-    hide_img(img)
-    users = manager.get_users()
-    for user in users:
-        with open(f'hidden_img/{img}', 'rb') as photo:
-            bot.send_photo(user, photo, 
-                         caption="🎨 Новая картинка в аукционе!\n"
-                                f"Трое первых получат её и +{manager.get_setting('bonus_per_win')} бонусов!",
-                         reply_markup=gen_markup(id=prize_id))
-
-def shedule_thread():
-    time.sleep(5)
-    send_message()
-    
-    interval = int(manager.get_setting('message_interval'))
-    schedule.every(interval).minutes.do(send_message)
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    if not os.path.exists(f'hidden_img/{img}'):
+        metrics.IMAGE_SECONDS.observe(hide_img_timed(img), op='hide_img')
+    caption = ("🎨 Новая картинка в аукционе!\n"
+               f"Трое первых получат её и +{manager.get_setting('bonus_per_win')} бонусов!")
+    for users in manager.iter_user_chunks():
+        manager.enqueue_messages(users, img, caption, prize_id)
+
+def expire_re_auctions_job():
+    manager.expire_re_auctions()
+    schedule_re_auction_expiry()
+
+def schedule_re_auction_expiry():
+    # Один таймер на ближайшее окончание повторного аукциона
+    end = manager.get_re_auction_index().next_end()
+    if end is not None:
+        scheduler.at('re_auction_expiry', end.timestamp(), expire_re_auctions_job)
+
+def schedule_lots():
+    # Время следующего лота сохраняется в БД: после перезапуска сетка
+    # продолжается с того же места, без внепланового лота при старте
+    interval = manager.get_setting('message_interval') * 60
+    if interval <= 0:
+        # Неверное значение могло попасть в БД раньше — не падаем при старте
+        logging.error('message_interval must be positive, got %s; using 1 min', interval // 60)
+        interval = 60
+    next_lot_at = manager.get_setting('next_lot_at')
+    now = time.time()
+    if next_lot_at is None:
+        first = now + FIRST_LOT_DELAY
+    elif next_lot_at >= now:
+        first = next_lot_at
+    else:
+        first = next_lot_at + interval * (int((now - next_lot_at) // interval) + 1)
+    
+    scheduler.every('lot', interval, send_message, first=first,
+                    on_schedule=lambda when: manager.update_setting('next_lot_at', when))
+    manager.subscribe('message_interval', lambda minutes: scheduler.set_interval('lot', minutes * 60))
 
 @bot.message_handler(commands=['start'])
 def handle_start(message):
     user_id = message.chat.id
-    if user_id in manager.get_users():
+    if manager.is_registered(user_id):
         bot.reply_to(message, "Ты уже зарегестрирован!")
     else:
         manager.add_user(user_id, message.from_user.username)
@@ -172,11 +292,8 @@ def handle_start(message):
 /re_auctions - активные повторные аукционы""")
         
         if _last_prize_id is not None and _last_img is not None:
-            winners_count = manager.get_winners_count(_last_prize_id)
-            if winners_count < int(manager.get_setting('winners_per_prize')):
-                photo_path = os.path.join(BASE_DIR, 'hidden_img', _last_img)
-                with open(photo_path, 'rb') as photo:
-                    bot.send_photo(user_id, photo, 
+            if not journal.is_sold_out(_last_prize_id):
+                send_prize_photo(user_id, _last_img, hidden=True, 
                                  caption="🎨 Текущая картинка в аукционе!",
                                  reply_markup=gen_markup(id=_last_prize_id))
 
@@ -189,7 +306,7 @@ def handle_bonus(message):
 @bot.message_handler(commands=['re_auctions'])
 def handle_re_auctions(message):
     user_id = message.chat.id
-    active = manager.get_active_re_auctions()
+    active = manager.list_re_auctions()
     
     if not active:
         bot.send_message(user_id, "Сейчас нет активных повторных аукционов!")
@@ -216,36 +333,38 @@ def handle_rating(message):
     for x in res:
         name = f'@{x[0]}' if x[0] else '(no name)'
         lines.append(f'| {name:<{w1}} | {x[1]:<{w2}} | {x[2]:<{w3}} |')
-    bot.send_message(message.chat.id, '<pre>' + '\n'.join(lines) + '</pre>', parse_mode='HTML')
+    text = '<pre>' + '\n'.join(lines) + '</pre>'
+    rank = manager.get_user_rank(message.chat.id)
+    if rank is not None:
+        text += f'\n🏆 Ты на {rank} месте!'
+    bot.send_message(message.chat.id, text, parse_mode='HTML')
 
 @bot.message_handler(commands=['get_my_score'])
 def handle_get_my_score(message):
     user_id = message.chat.id
     
-    won_prizes = manager.get_winners_img(user_id)
     all_images = os.listdir('img')
+    if not all_images:
+        bot.send_message(user_id, "В аукционе пока нет картинок!")
+        return
+    won_count, pages = collages.get(user_id, all_images, lambda: manager.get_winners_img(user_id))
+    caption = (f"🎨 Твоя коллекция!\n"
+               f"✅ Получено: {won_count} из {len(all_images)}\n"
+               f"💰 Бонусы: {manager.get_user_bonus(user_id)}")
     
-    image_paths = []
-    for img in all_images:
-        if img in won_prizes:
-            image_paths.append(f'img/{img}')
-        else:
-            hidden_path = f'hidden_img/{img}'
-            if not os.path.exists(hidden_path):
-                hide_img(img)
-            image_paths.append(hidden_path)
-    
-    collage = create_collage(image_paths)
-    collage_path = f'temp_collage_{user_id}.jpg'
-    cv2.imwrite(collage_path, collage)
-    
-    with open(collage_path, 'rb') as photo:
-        bot.send_photo(user_id, photo, 
-                     caption=f"🎨 Твоя коллекция!\n"
-                            f"✅ Получено: {len(won_prizes)} из {len(all_images)}\n"
-                            f"💰 Бонусы: {manager.get_user_bonus(user_id)}")
+    if len(pages) == 1:
+        bot.send_photo(user_id, as_upload(pages[0]), caption=caption)
+        return
     
-    os.remove(collage_path)
+    # В медиагруппе Telegram от 2 до 10 фото: страницы делятся на группы
+    # почти равного размера, чтобы последняя не осталась из одного фото
+    groups = -(-len(pages) // 10)
+    bounds = [len(pages) * i // groups for i in range(groups + 1)]
+    for start, end in zip(bounds, bounds[1:]):
+        media = [InputMediaPhoto(as_upload(page)) for page in pages[start:end]]
+        if start == 0:
+            media[0].caption = caption
+        bot.send_media_group(user_id, media)
 
 @bot.message_handler(commands=['admin'])
 def handle_admin(message):
@@ -268,6 +387,7 @@ def handle_admin(message):
 /admin_bonus [количество] - установить бонус за победу
 /admin_re_cost [бонусы] - установить стоимость повторного аукциона
 /admin_re_duration [минуты] - установить длительность повторного аукциона
+/admin_reload - перечитать настройки из БД
     """
     bot.send_message(user_id, text)
 
@@ -294,13 +414,39 @@ def handle_admin_settings(message):
     """
     bot.send_message(user_id, text)
 
+def parse_setting(message, setting_name):
+    # Аргумент команды администратора: целое число в пределах SETTING_LIMITS,
+    # иначе — сообщение об ошибке и None
+    low, high = SETTING_LIMITS[setting_name]
+    args = message.text.split()
+    try:
+        value = int(args[1])
+    except (IndexError, ValueError):
+        value = None
+    if value is None or not low <= value <= high:
+        bot.send_message(message.chat.id, f"❌ Нужно целое число от {low} до {high}")
+        return None
+    return value
+
+@bot.message_handler(commands=['admin_reload'])
+def handle_admin_reload(message):
+    user_id = message.chat.id
+    if not manager.check_admin(user_id):
+        return
+    
+    # Подхватывает правки bot_settings, сделанные мимо бота (например, из sqlite3)
+    manager.reload_settings()
+    bot.send_message(user_id, "✅ Настройки перечитаны из БД")
+
 @bot.message_handler(commands=['admin_interval'])
 def handle_admin_interval(message):
     user_id = message.chat.id
     if not manager.check_admin(user_id):
         return
     
-    interval = message.text.split()[1]
+    interval = parse_setting(message, 'message_interval')
+    if interval is None:
+        return
     manager.update_setting('message_interval', interval)
     bot.send_message(user_id, f"✅ Интервал рассылки изменен на {interval} мин")
 
@@ -310,7 +456,9 @@ def handle_admin_winners(message):
     if not manager.check_admin(user_id):
         return
     
-    winners = message.text.split()[1]
+    winners = parse_setting(message, 'winners_per_prize')
+    if winners is None:
+        return
     manager.update_setting('winners_per_prize', winners)
     bot.send_message(user_id, f"✅ Количество победителей изменено на {winners}")
 
@@ -320,7 +468,9 @@ def handle_admin_bonus(message):
     if not manager.check_admin(user_id):
         return
     
-    bonus = message.text.split()[1]
+    bonus = parse_setting(message, 'bonus_per_win')
+    if bonus is None:
+        return
     manager.update_setting('bonus_per_win', bonus)
     bot.send_message(user_id, f"✅ Бонус за победу изменен на {bonus}")
 
@@ -330,7 +480,9 @@ def handle_admin_re_cost(message):
     if not manager.check_admin(user_id):
         return
     
-    cost = message.text.split()[1]
+    cost = parse_setting(message, 're_auction_bonus_cost')
+    if cost is None:
+        return
     manager.update_setting('re_auction_bonus_cost', cost)
     bot.send_message(user_id, f"✅ Стоимость повторного аукциона изменена на {cost}")
 
@@ -340,7 +492,9 @@ def handle_admin_re_duration(message):
     if not manager.check_admin(user_id):
         return
     
-    duration = message.text.split()[1]
+    duration = parse_setting(message, 're_auction_duration')
+    if duration is None:
+        return
     manager.update_setting('re_auction_duration', duration)
     bot.send_message(user_id, f"✅ Длительность повторного аукциона изменена на {duration} мин")
 
@@ -352,26 +506,66 @@ def handle_admin_add_prize(message):
     
     bot.send_message(user_id, "Отправь мне фото, которое хочешь добавить в аукцион")
 
+def download_file(file_path, destination):
+    # Файл пишется на диск по частям, не собираясь целиком в памяти
+    if apihelper.FILE_URL is None:
+        url = f"https://api.telegram.org/file/bot{API_TOKEN}/{file_path}"
+    else:
+        url = apihelper.FILE_URL.format(API_TOKEN, file_path)
+    with apihelper._get_req_session().get(url, stream=True, proxies=apihelper.proxy,
+                                          timeout=apihelper.READ_TIMEOUT) as response:
+        if response.status_code != 200:
+            raise ApiHTTPException('Download file', response)
+        with open(destination, 'wb') as f:
+            for chunk in response.iter_content(UPLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+def process_upload(user_id, file_id):
+    # Скачивание, нормализация и производные версии — во временных файлах
+    # uploads/; в img/, hidden_img/ и display_img/ готовые файлы переносятся
+    # атомарно под именем по хэшу содержимого, после чего приз регистрируется в БД.
+    # Если регистрация не удалась, перенесённые файлы удаляются
+    raw_path = os.path.join('uploads', uuid.uuid4().hex)
+    paths = [raw_path]
+    moved = []
+    try:
+        download_file(bot.get_file(file_id).file_path, raw_path)
+        file_name, content_hash, phash, original_path, hidden_path, display_path = \
+            image_pool.submit(normalize_upload, raw_path).result()
+        paths += [x for x in (original_path, hidden_path, display_path) if x]
+
+        existing = manager.find_prize_by_hash(content_hash)
+        if existing:
+            bot.send_message(user_id, f"⚠️ Такая картинка уже есть в аукционе: {existing}")
+            return
+        for path, directory in ((hidden_path, 'hidden_img'), (display_path, 'display_img'),
+                                (original_path, 'img')):
+            if path:
+                moved.append(os.path.join(directory, file_name))
+                os.replace(path, moved[-1])
+        # Строка приза добавляется последней: после неё откатывать уже нечего
+        manager.set_hidden_hashes([(file_name, content_hash, HIDE_PARAMS)])
+        manager.add_prize([(file_name, content_hash, phash)], user_id)
+    except Exception:
+        logging.exception('failed to process upload from %s', user_id)
+        paths += moved
+        bot.send_message(user_id, "❌ Не удалось добавить картинку, подробности в логе")
+        return
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    bot.send_message(user_id, f"✅ Картинка {file_name} успешно добавлена!")
+
 @bot.message_handler(content_types=['photo'])
 def handle_photo(message):
     user_id = message.chat.id
     if not manager.check_admin(user_id):
         return
     
-    file_info = bot.get_file(message.photo[-1].file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-    
-    if not os.path.exists('img'):
-        os.makedirs('img')
-        
-    file_name = f"prize_{int(time.time())}.jpg"
-    file_path = os.path.join('img', file_name)
-    
-    with open(file_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
-    
-    manager.add_prize([(file_name,)], user_id)
-    bot.send_message(user_id, f"✅ Картинка {file_name} успешно добавлена!")
+    # Подтверждение уходит до постановки в очередь, чтобы не обогнать ответ с результатом
+    bot.send_message(user_id, "⏳ Картинка получена, обрабатываю...")
+    background.submit(process_upload, user_id, message.photo[-1].file_id)
 
 @bot.message_handler(commands=['admin_prizes'])
 def handle_admin_prizes(message):
@@ -409,23 +603,78 @@ def handle_admin_set_admin(message):
         return
     
     new_admin_id = int(message.text.split()[1])
+    if not manager.user_exists(new_admin_id):
+        bot.send_message(user_id, f"❌ Пользователь {new_admin_id} не найден")
+        return
     manager.set_admin(new_admin_id)
     bot.send_message(user_id, f"✅ Пользователь {new_admin_id} теперь администратор")
 
+def instrument_handlers():
+    # Время каждого обработчика — в гистограмму с меткой по имени функции
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            func = handler['function']
+            handler['function'] = metrics.timed(metrics.HANDLER_SECONDS, handler=func.__name__)(func)
+
+instrument_handlers()
+
+def dump_metrics_job():
+    metrics.dump(METRICS_FILE)
+
 def polling_thread():
     bot.polling(none_stop=True)
 
-if __name__ == '__main__':
+def init():
+    global manager, journal
+    if API_URL:
+        apihelper.API_URL = API_URL
+    if FILE_URL:
+        apihelper.FILE_URL = FILE_URL
     manager = DatabaseManager(DATABASE)
     manager.create_tables()
+    journal = ClaimJournal(manager)
 
     if not os.path.exists('img'):
         os.makedirs('img')
     if not os.path.exists('hidden_img'):
         os.makedirs('hidden_img')
+    os.makedirs('display_img', exist_ok=True)
+    os.makedirs('uploads', exist_ok=True)
+    prepare_hidden_images(manager, image_pool)
+    manager.get_re_auction_index()
+    metrics.OUTBOX_PENDING.func = manager.get_outbox_pending_count
+
+def start_workers():
+    schedule_lots()
+    schedule_re_auction_expiry()
+    scheduler.every('outbox', OUTBOX_DRAIN_INTERVAL, drain_outbox_job, first=time.time(), expect_overlap=True)
+    scheduler.every('outbox_prune', OUTBOX_PRUNE_INTERVAL, prune_outbox_job, first=time.time())
+    if METRICS_FILE:
+        scheduler.every('metrics', METRICS_DUMP_INTERVAL, dump_metrics_job)
+    threading.Thread(target=scheduler.run, daemon=True).start()
+
+def shutdown():
+    scheduler.stop()
+    if METRICS_FILE:
+        dump_metrics_job()
+    broadcaster.shutdown()
+    background.shutdown()
+    image_pool.shutdown()
+    journal.stop()
+    manager.close()
 
-    polling_thread = threading.Thread(target=polling_thread)
-    polling_shedule = threading.Thread(target=shedule_thread)
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    init()
 
+    polling_thread = threading.Thread(target=polling_thread)
     polling_thread.start()
-    polling_shedule.start()
\ No newline at end of file
+    start_workers()
+
+    try:
+        polling_thread.join()
+    except KeyboardInterrupt:
+        bot.stop_polling()
+        polling_thread.join()
+    finally:
+        shutdown()
\ No newline at end of file
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import metrics
+from config import BROADCAST_WORKERS, BROADCAST_RATE, BROADCAST_CHAT_INTERVAL, BROADCAST_RETRIES
+
+logger = logging.getLogger(__name__)
+
+def retry_after(error):
+    # Telegram отвечает 429 и сообщает, сколько секунд подождать
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    result = getattr(error, 'result_json', None) or {}
+    return result.get('parameters', {}).get('retry_after', 1)
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        # После 429 останавливаем всех воркеров, а не только получивший ошибку
+        with self._lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+class Broadcaster:
+    def __init__(self, workers=BROADCAST_WORKERS, rate=BROADCAST_RATE,
+                 chat_interval=BROADCAST_CHAT_INTERVAL, retries=BROADCAST_RETRIES):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast')
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.retries = retries
+        self._chat_last = OrderedDict()
+        self._chat_lock = threading.Lock()
+
+    def _wait_chat(self, chat_id):
+        with self._chat_lock:
+            now = time.monotonic()
+            last = self._chat_last.pop(chat_id, None)
+            ready = now if last is None else max(now, last + self.chat_interval)
+            self._chat_last[chat_id] = ready
+            # Записи идут примерно в порядке времени: из начала убираются те,
+            # чей интервал уже прошёл, чтобы словарь не рос с числом чатов
+            while self._chat_last:
+                oldest = next(iter(self._chat_last.values()))
+                if oldest + self.chat_interval > now:
+                    break
+                self._chat_last.popitem(last=False)
+        if ready > now:
+            time.sleep(ready - now)
+
+    def deliver(self, chat_id, send):
+        for attempt in range(self.retries + 1):
+            self._wait_chat(chat_id)
+            self.bucket.acquire()
+            try:
+                return send(chat_id)
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None or attempt == self.retries:
+                    raise
+                logger.warning('429 for chat %s, retry after %s s', chat_id, delay)
+                metrics.BROADCAST_THROTTLED.inc()
+                self.bucket.pause(delay)
+
+    def run(self, items, send, name='broadcast', prime=0, key=None):
+        # prime — сколько получателей обслужить последовательно до параллельной
+        # рассылки (первая отправка загружает файл и сохраняет его file_id);
+        # key достаёт chat_id, если items — не сами chat_id
+        items = list(items)
+        key = key or (lambda item: item)
+        stats = {'name': name, 'total': len(items), 'sent': 0, 'failed': 0}
+        lock = threading.Lock()
+        step = max(1, len(items) // 10)
+        started = time.monotonic()
+        progress = metrics.BROADCAST_PROGRESS.labels(name=name)
+        progress.set(0)
+        metrics.BROADCAST_TOTAL.set(stats['total'], name=name)
+
+        def task(item):
+            try:
+                self.deliver(key(item), lambda chat_id: send(item))
+                ok = True
+            except Exception as e:
+                logger.warning('%s: failed to deliver to %s: %s', name, key(item), e)
+                ok = False
+            with lock:
+                stats['sent' if ok else 'failed'] += 1
+                done = stats['sent'] + stats['failed']
+                progress.set(done)
+            metrics.BROADCAST_MESSAGES.inc(name=name, result='sent' if ok else 'failed')
+            if done % step == 0:
+                logger.info('%s: %d/%d delivered', name, done, stats['total'])
+
+        for item in items[:prime]:
+            task(item)
+        wait([self.executor.submit(task, item) for item in items[prime:]])
+
+        stats['elapsed'] = time.monotonic() - started
+        metrics.BROADCAST_SECONDS.observe(stats['elapsed'], name=name)
+        stats['rate'] = stats['sent'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        logger.info('%s: %d sent, %d failed in %.1f s (%.1f msg/s)',
+                    name, stats['sent'], stats['failed'], stats['elapsed'], stats['rate'])
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -1,2 +1,57 @@
 API_TOKEN = ''
 DATABASE = 'data.db'
+
+DB_BUSY_TIMEOUT = 5000      # мс ожидания блокировки SQLite
+DB_SYNCHRONOUS = 'NORMAL'   # в режиме WAL NORMAL безопасен и не делает fsync на каждый коммит
+
+BROADCAST_WORKERS = 8           # параллельных отправок при рассылке
+BROADCAST_RATE = 25             # сообщений в секунду на весь бот (лимит Telegram ~30)
+BROADCAST_CHAT_INTERVAL = 1.0   # секунд между сообщениями в один чат
+BROADCAST_RETRIES = 3           # повторов после ответа 429
+
+OUTBOX_BATCH = 200              # сообщений, забираемых из очереди за раз
+OUTBOX_LEASE = 60               # секунд до повторной выдачи неподтверждённого сообщения
+OUTBOX_MAX_PENDING = 5000       # больше сообщений в очереди — новый лот ждёт
+OUTBOX_MAX_ATTEMPTS = 5         # после стольких ошибок сообщение уходит в dead
+OUTBOX_BACKOFF = 5              # секунд до первого повтора, дальше удваивается
+OUTBOX_DEAD_TTL = 86400         # секунд хранения недоставленных (dead) сообщений
+OUTBOX_PRUNE_INTERVAL = 3600    # секунд между очистками старых dead-сообщений
+
+IMAGE_WORKERS = None            # процессов для обработки картинок (None — по числу ядер)
+HIDDEN_SIDE = 240               # большая сторона скрытой версии, px (8 px на каждый из 30 блоков)
+HIDDEN_JPEG_QUALITY = 60        # качество JPEG скрытой версии
+DISPLAY_SIDE = 1280             # большая сторона версии для победителей — столько показывает Telegram, px
+DISPLAY_JPEG_QUALITY = 87       # качество JPEG версии для победителей
+UPLOAD_MAX_SIDE = 1280          # большая сторона картинки, загруженной админом, px
+UPLOAD_JPEG_QUALITY = 90        # качество JPEG при перекодировании загрузки
+UPLOAD_CHUNK_SIZE = 1 << 16     # байт за одну запись при скачивании файла
+IMPORT_PHASH_DISTANCE = 4       # картинки с перцептивными хэшами ближе этого (бит из 64) считаются дублями
+
+TILE_SIZE = 128                 # сторона миниатюры в коллекции /get_my_score, px
+TILE_CACHE_BYTES = 96 << 20     # байт под миниатюры в памяти (одна 128x128 — 48 КБ)
+COLLAGE_PAGE_SIZE = 100         # клеток на одной странице коллекции (10x10)
+COLLAGE_CACHE_BYTES = 64 << 20  # байт под готовые коллекции в памяти
+IMAGE_CACHE_BYTES = 64 << 20    # байт под файлы картинок для отправки
+IMAGE_MMAP_THRESHOLD = 1 << 20  # файлы от этого размера читаются через mmap
+
+USER_CHUNK_SIZE = 1000          # пользователей в одной порции при постановке рассылки в очередь
+
+SCHEDULER_WORKERS = 4           # потоков для задач планировщика
+FIRST_LOT_DELAY = 5             # секунд до первого лота при самом первом запуске
+OUTBOX_DRAIN_INTERVAL = 0.5     # секунд между проверками очереди сообщений
+
+API_URL = None                  # свой адрес Bot API, например 'http://127.0.0.1:8081/bot{0}/{1}' для локального стаба
+FILE_URL = None                 # свой адрес для скачивания файлов, например 'http://127.0.0.1:8081/file/bot{0}/{1}'
+HANDLER_CONCURRENCY = 16        # обработчиков, выполняемых одновременно (runtime.py)
+POLLING_TIMEOUT = 20            # секунд long polling в getUpdates
+WEBHOOK_HOST = '0.0.0.0'        # где слушать вебхук
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_URL = ''                # внешний адрес, например 'https://example.com'
+WEBHOOK_SECRET = ''             # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+
+CLAIM_FLUSH_INTERVAL = 0.005    # секунд, за которые выигрыши собираются в одну транзакцию
+CLAIM_FLUSH_BATCH = 32          # выигрышей, после которых пачка пишется сразу
+
+METRICS_FILE = 'metrics.prom'   # куда периодически писать метрики в формате Prometheus ('' — не писать)
+METRICS_DUMP_INTERVAL = 15      # секунд между записями файла метрик
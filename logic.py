@@ -1,17 +1,181 @@
 import sqlite3
+import hashlib
+import mmap
+import heapq
+import logging
+import random
+import shutil
+import sys
+import threading
+import time
 from datetime import datetime, timedelta
-from config import DATABASE 
+from config import DATABASE, DB_BUSY_TIMEOUT, DB_SYNCHRONOUS, OUTBOX_LEASE, OUTBOX_DEAD_TTL, IMAGE_WORKERS, USER_CHUNK_SIZE, TILE_SIZE, TILE_CACHE_BYTES, COLLAGE_PAGE_SIZE, COLLAGE_CACHE_BYTES, \
+    CLAIM_FLUSH_INTERVAL, CLAIM_FLUSH_BATCH, IMPORT_PHASH_DISTANCE, UPLOAD_MAX_SIDE, UPLOAD_JPEG_QUALITY, \
+    HIDDEN_SIDE, HIDDEN_JPEG_QUALITY, DISPLAY_SIDE, DISPLAY_JPEG_QUALITY, IMAGE_CACHE_BYTES, IMAGE_MMAP_THRESHOLD
 import os
 import cv2
 import numpy as np
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 from math import sqrt, ceil, floor
+import metrics
 
+logger = logging.getLogger(__name__)
+
+CLAIM_WON = 'won'
+CLAIM_ALREADY_WON = 'already_won'
+CLAIM_SOLD_OUT = 'sold_out'
+CLAIM_NO_BONUS = 'no_bonus'
+
+MIGRATIONS = [
+    # 1: один выигрыш на пару (user_id, prize_id)
+    [
+        '''DELETE FROM winners WHERE rowid NOT IN (
+           SELECT MIN(rowid) FROM winners GROUP BY user_id, prize_id)''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_winners_user_prize ON winners(user_id, prize_id)',
+    ],
+    # 2: file_id загруженных в Telegram картинок
+    [
+        '''CREATE TABLE IF NOT EXISTS photo_files (
+            image TEXT,
+            variant TEXT,
+            file_id TEXT,
+            PRIMARY KEY(image, variant)
+        )''',
+    ],
+    # 3: хэши оригиналов, по которым построены скрытые картинки
+    [
+        '''CREATE TABLE IF NOT EXISTS hidden_images (
+            image TEXT PRIMARY KEY,
+            content_hash TEXT,
+            params TEXT
+        )''',
+    ],
+    # 4: очередь исходящих сообщений
+    [
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER,
+            image TEXT,
+            caption TEXT,
+            prize_id INTEGER,
+            is_re_auction INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt REAL,
+            last_error TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, next_attempt)',
+    ],
+    # 5: индексы для частых выборок
+    [
+        'CREATE INDEX IF NOT EXISTS idx_winners_prize ON winners(prize_id)',
+        'CREATE INDEX IF NOT EXISTS idx_prizes_used ON prizes(used)',
+        'CREATE INDEX IF NOT EXISTS idx_re_auctions_end_time ON re_auctions(end_time)',
+    ],
+    # 6: перемешанная колода призов — следующий приз берётся по индексу
+    [
+        'ALTER TABLE prizes ADD COLUMN deck_pos REAL',
+        'UPDATE prizes SET deck_pos = abs(random()) / 9223372036854775808.0',
+        'DROP INDEX IF EXISTS idx_prizes_used',
+        'CREATE INDEX IF NOT EXISTS idx_prizes_deck ON prizes(used, deck_pos)',
+    ],
+    # 7: счётчик выигрышей для рейтинга ведётся вместе с записью победителя
+    [
+        'ALTER TABLE users ADD COLUMN win_count INTEGER DEFAULT 0',
+        '''UPDATE users SET win_count = (
+           SELECT COUNT(*) FROM winners WHERE winners.user_id = users.user_id)''',
+        'CREATE INDEX IF NOT EXISTS idx_users_win_count ON users(win_count)',
+    ],
+    # 8: выборка пользователей, которым хватает бонусов на повторный аукцион
+    [
+        'CREATE INDEX IF NOT EXISTS idx_users_bonus ON users(bonus_balance, user_id)',
+    ],
+    # 9: хэши содержимого и перцептивные хэши для поиска дублей при импорте
+    [
+        'ALTER TABLE prizes ADD COLUMN content_hash TEXT',
+        'ALTER TABLE prizes ADD COLUMN phash TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_prizes_content_hash ON prizes(content_hash)',
+    ],
+    # 10: пользователи, заблокировавшие бота, не получают рассылки
+    [
+        'ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0',
+    ],
+]
+
+SETTING_TYPES = {
+    'message_interval': int,
+    'winners_per_prize': int,
+    'bonus_per_win': int,
+    're_auction_bonus_cost': int,
+    're_auction_duration': int,
+    'next_lot_at': float
+}
+
+# Допустимые значения настроек, которые меняет администратор
+SETTING_LIMITS = {
+    'message_interval': (1, 24 * 60),
+    'winners_per_prize': (1, 100),
+    'bonus_per_win': (0, 10000),
+    're_auction_bonus_cost': (0, 10000),
+    're_auction_duration': (1, 24 * 60),
+}
+
+HIDE_BLUR = 15
+HIDE_BLOCKS = 30
+# Параметры всех производных версий: при их изменении версии пересчитываются
+HIDE_PARAMS = (f'blur={HIDE_BLUR};blocks={HIDE_BLOCKS};hidden={HIDDEN_SIDE}q{HIDDEN_JPEG_QUALITY};'
+               f'display={DISPLAY_SIDE}q{DISPLAY_JPEG_QUALITY}')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+# Методы, которые отвечают из памяти, не замеряются
+@metrics.instrumented(metrics.DB_SECONDS, skip=('connect', 'close', 'get_setting', 'subscribe', 'get_user_registry',
+                                                'is_registered', 'iter_user_chunks', 'get_re_auction_index',
+                                                'get_re_auction', 'list_re_auctions', 'expire_re_auctions'))
 class DatabaseManager:
     def __init__(self, database):
         self.database = database
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._settings = None
+        self._settings_lock = threading.Lock()
+        self._subscribers = {}
+        self._rating = None
+        # Поколение кэша рейтинга: чтение, начатое до сброса, не перезапишет кэш
+        self._rating_gen = 0
+        self._rating_lock = threading.Lock()
+        self._users = None
+        self._users_lock = threading.Lock()
+        self._re_auctions = None
+        self._re_auctions_lock = threading.Lock()
+
+    def connect(self):
+        # Одно долгоживущее соединение на поток: поток polling и планировщик
+        # работают параллельно, а WAL позволяет читать во время записи
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.database, timeout=DB_BUSY_TIMEOUT / 1000,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={DB_SYNCHRONOUS}')
+            conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT)}')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
 
     def create_tables(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -62,8 +226,24 @@ class DatabaseManager:
 
             conn.commit()
             
+            self.migrate()
             self.init_default_settings()
 
+    def migrate(self):
+        # Номер последней применённой миграции хранится в PRAGMA user_version;
+        # каждая миграция применяется в своей транзакции
+        conn = self.connect()
+        while True:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    return
+                for sql in MIGRATIONS[version]:
+                    conn.execute(sql)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+            logger.info('database migrated to version %d', version + 1)
+
     def init_default_settings(self):
         default_settings = {
             'message_interval': '1',
@@ -73,37 +253,129 @@ class DatabaseManager:
             're_auction_duration': '5'
         }
         
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             for name, value in default_settings.items():
                 conn.execute('''INSERT OR IGNORE INTO bot_settings (setting_name, setting_value) 
                               VALUES (?, ?)''', (name, value))
             conn.commit()
+        self._settings = None
 
-    def get_setting(self, setting_name):
-        conn = sqlite3.connect(self.database)
+    def _load_settings(self):
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
-            cur.execute('SELECT setting_value FROM bot_settings WHERE setting_name = ?', (setting_name,))
-            result = cur.fetchone()
-            return result[0] if result else None
+            cur.execute('SELECT setting_name, setting_value FROM bot_settings')
+            return {name: SETTING_TYPES.get(name, str)(value) for name, value in cur.fetchall()}
+
+    def get_setting(self, setting_name):
+        # Настройки читаются из БД один раз и дальше живут в памяти;
+        # update_setting меняет и БД, и кэш
+        settings = self._settings
+        if settings is None:
+            with self._settings_lock:
+                if self._settings is None:
+                    self._settings = self._load_settings()
+                settings = self._settings
+        return settings.get(setting_name)
 
     def update_setting(self, setting_name, setting_value):
-        conn = sqlite3.connect(self.database)
+        value = SETTING_TYPES.get(setting_name, str)(setting_value)
+        if setting_name in SETTING_LIMITS:
+            low, high = SETTING_LIMITS[setting_name]
+            if not low <= value <= high:
+                raise ValueError(f'{setting_name} must be between {low} and {high}, got {value}')
+        with self._settings_lock:
+            conn = self.connect()
+            with conn:
+                conn.execute('''INSERT INTO bot_settings (setting_name, setting_value) VALUES (?, ?)
+                              ON CONFLICT(setting_name) DO UPDATE SET setting_value = excluded.setting_value''',
+                             (setting_name, str(value)))
+                conn.commit()
+            if self._settings is not None:
+                self._settings = {**self._settings, setting_name: value}
+        self._notify(setting_name, value)
+
+    def reload_settings(self):
+        with self._settings_lock:
+            old, self._settings = self._settings or {}, self._load_settings()
+            settings = self._settings
+        for name, value in settings.items():
+            if old.get(name) != value:
+                self._notify(name, value)
+
+    def subscribe(self, setting_name, callback):
+        self._subscribers.setdefault(setting_name, []).append(callback)
+
+    def _notify(self, setting_name, value):
+        for callback in self._subscribers.get(setting_name, []):
+            try:
+                callback(value)
+            except Exception:
+                logger.exception('setting subscriber failed for %s', setting_name)
+
+    def add_user(self, user_id, user_name):
+        conn = self.connect()
         with conn:
-            conn.execute('''UPDATE bot_settings SET setting_value = ? 
-                          WHERE setting_name = ?''', (setting_value, setting_name))
+            # Повторный /start от заблокировавшего бота пользователя снимает блокировку
+            conn.execute('''INSERT INTO users (user_id, user_name, bonus_balance, is_admin) VALUES (?, ?, 0, 0)
+                          ON CONFLICT(user_id) DO UPDATE SET blocked = 0''', (user_id, user_name))
             conn.commit()
+        if self._users is not None:
+            self._users.add(user_id)
 
-    def add_user(self, user_id, user_name):
-        conn = sqlite3.connect(self.database)
+    def mark_blocked(self, user_id):
+        conn = self.connect()
         with conn:
-            conn.execute('INSERT INTO users (user_id, user_name, bonus_balance, is_admin) VALUES (?, ?, 0, 0)', 
-                        (user_id, user_name))
+            conn.execute('UPDATE users SET blocked = 1 WHERE user_id = ?', (user_id,))
             conn.commit()
+        if self._users is not None:
+            self._users.discard(user_id)
+
+    def get_user_registry(self):
+        if self._users is None:
+            with self._users_lock:
+                if self._users is None:
+                    self._users = UserRegistry(self.get_users())
+        return self._users
+
+    def is_registered(self, user_id):
+        return user_id in self.get_user_registry()
+
+    def iter_user_chunks(self, size=USER_CHUNK_SIZE):
+        return self.get_user_registry().chunks(size)
+
+    def iter_eligible_users(self, min_bonus, size=USER_CHUNK_SIZE):
+        # Порции по индексу (bonus_balance, user_id): каждая порция — отдельный
+        # короткий запрос, между ними соединение свободно для записи
+        last = (min_bonus, None)
+        conn = self.connect()
+        while True:
+            with conn:
+                cur = conn.cursor()
+                if last[1] is None:
+                    cur.execute('''SELECT bonus_balance, user_id FROM users 
+                                  WHERE bonus_balance >= ? AND blocked = 0 
+                                  ORDER BY bonus_balance, user_id LIMIT ?''', (min_bonus, size))
+                else:
+                    cur.execute('''SELECT bonus_balance, user_id FROM users 
+                                  WHERE (bonus_balance, user_id) > (?, ?) AND blocked = 0 
+                                  ORDER BY bonus_balance, user_id LIMIT ?''', (last[0], last[1], size))
+                rows = cur.fetchall()
+            if not rows:
+                return
+            yield [x[1] for x in rows]
+            last = rows[-1]
+
+    def user_exists(self, user_id):
+        conn = self.connect()
+        with conn:
+            cur = conn.cursor()
+            cur.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,))
+            return cur.fetchone() is not None
 
     def check_admin(self, user_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
             cur.execute('SELECT is_admin FROM users WHERE user_id = ?', (user_id,))
@@ -113,40 +385,120 @@ class DatabaseManager:
             return False
 
     def set_admin(self, user_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             conn.execute('UPDATE users SET is_admin = 1 WHERE user_id = ?', (user_id,))
             conn.commit()
 
+    def _deck_positions(self, cur, count):
+        # Новые призы встают в случайные места ещё не пройденной части колоды
+        cur.execute('SELECT MIN(deck_pos) FROM prizes WHERE used = 0')
+        low = cur.fetchone()[0] or 0.0
+        return [random.uniform(low, 1.0) for _ in range(count)]
+
     def add_prize(self, data, added_by=None):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             added_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            for item in data:
-                conn.execute('''INSERT INTO prizes (image, used, added_by, added_date) 
-                              VALUES (?, 0, ?, ?)''', (item[0], added_by, added_date))
+            positions = self._deck_positions(conn.cursor(), len(data))
+            # data — кортежи (image,) или (image, content_hash, phash)
+            rows = []
+            for item, pos in zip(data, positions):
+                content_hash, phash = item[1:3] if len(item) > 1 else (None, None)
+                rows.append((item[0], added_by, added_date, pos, content_hash, phash))
+            conn.executemany('''INSERT INTO prizes (image, used, added_by, added_date, deck_pos, content_hash, phash) 
+                              VALUES (?, 0, ?, ?, ?, ?, ?)''', rows)
+            conn.commit()
+
+    def find_prize_by_hash(self, content_hash):
+        conn = self.connect()
+        with conn:
+            cur = conn.cursor()
+            cur.execute('SELECT image FROM prizes WHERE content_hash = ? LIMIT 1', (content_hash,))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+    def get_prize_hashes(self):
+        conn = self.connect()
+        with conn:
+            cur = conn.cursor()
+            cur.execute('SELECT image, content_hash, phash FROM prizes')
+            return {x[0]: (x[1], x[2]) for x in cur.fetchall()}
+
+    def set_prize_hashes(self, data):
+        # data — кортежи (content_hash, phash, image)
+        conn = self.connect()
+        with conn:
+            conn.executemany('UPDATE prizes SET content_hash = ?, phash = ? WHERE image = ?', data)
             conn.commit()
 
-    def add_winner(self, user_id, prize_id):
+    def claim_prize(self, user_id, prize_id, max_winners=None, bonus_cost=0):
+        if max_winners is None:
+            max_winners = self.get_setting('winners_per_prize')
+        bonus_per_win = self.get_setting('bonus_per_win')
         win_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        bonus_per_win = int(self.get_setting('bonus_per_win'))
-        
-        conn = sqlite3.connect(self.database)
+
+        conn = self.connect()
         with conn:
-            cur = conn.cursor() 
-            cur.execute("SELECT * FROM winners WHERE user_id = ? AND prize_id = ?", (user_id, prize_id))
-            if cur.fetchall():
-                return 0
+            conn.execute('BEGIN IMMEDIATE')
+            cur = conn.cursor()
+            cur.execute('''INSERT OR IGNORE INTO winners (user_id, prize_id, win_time)
+                          SELECT ?, ?, ?
+                          WHERE (SELECT COUNT(*) FROM winners WHERE prize_id = ?) < ?
+                            AND COALESCE((SELECT bonus_balance FROM users WHERE user_id = ?), 0) >= ?''',
+                        (user_id, prize_id, win_time, prize_id, max_winners, user_id, bonus_cost))
+            if cur.rowcount == 1:
+                conn.execute('''UPDATE users SET bonus_balance = bonus_balance + ?, win_count = win_count + 1 
+                              WHERE user_id = ?''', (bonus_per_win - bonus_cost, user_id))
+                status = CLAIM_WON
             else:
-                conn.execute('''INSERT INTO winners (user_id, prize_id, win_time) 
+                cur.execute('SELECT 1 FROM winners WHERE user_id = ? AND prize_id = ?', (user_id, prize_id))
+                if cur.fetchone():
+                    status = CLAIM_ALREADY_WON
+                else:
+                    cur.execute('SELECT COUNT(*) FROM winners WHERE prize_id = ?', (prize_id,))
+                    status = CLAIM_SOLD_OUT if cur.fetchone()[0] >= max_winners else CLAIM_NO_BONUS
+
+            cur.execute('SELECT image FROM prizes WHERE prize_id = ?', (prize_id,))
+            row = cur.fetchone()
+        # Сброс после фиксации транзакции, иначе рейтинг успеют прочитать без нового выигрыша
+        if status == CLAIM_WON:
+            self._invalidate_rating()
+        return status, row[0] if row else None
+
+    def get_lot_state(self, prize_id):
+        conn = self.connect()
+        with conn:
+            cur = conn.cursor()
+            cur.execute('SELECT image FROM prizes WHERE prize_id = ?', (prize_id,))
+            row = cur.fetchone()
+            if not row:
+                return None
+            cur.execute('SELECT user_id FROM winners WHERE prize_id = ?', (prize_id,))
+            return row[0], {x[0] for x in cur.fetchall()}
+
+    def record_wins(self, wins):
+        # Бонус и счётчик начисляются только за реально вставленные строки:
+        # выигрыш мог уже попасть в БД мимо журнала (через claim_prize).
+        # Возвращает список флагов «записан» в порядке wins
+        recorded = []
+        conn = self.connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cur = conn.cursor()
+            for user_id, prize_id, win_time, bonus in wins:
+                cur.execute('''INSERT OR IGNORE INTO winners (user_id, prize_id, win_time) 
                               VALUES (?, ?, ?)''', (user_id, prize_id, win_time))
-                conn.execute('''UPDATE users SET bonus_balance = bonus_balance + ? 
-                              WHERE user_id = ?''', (bonus_per_win, user_id))
-                conn.commit()
-                return 1
+                recorded.append(cur.rowcount == 1)
+                if recorded[-1]:
+                    cur.execute('''UPDATE users SET bonus_balance = bonus_balance + ?, win_count = win_count + 1 
+                                  WHERE user_id = ?''', (bonus, user_id))
+        if any(recorded):
+            self._invalidate_rating()
+        return recorded
 
     def get_user_bonus(self, user_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
             cur.execute('SELECT bonus_balance FROM users WHERE user_id = ?', (user_id,))
@@ -155,57 +507,65 @@ class DatabaseManager:
                 return result[0]
             return 0
 
-    def spend_bonus(self, user_id, amount):
-        conn = sqlite3.connect(self.database)
-        with conn:
-            cur = conn.cursor()
-            cur.execute('SELECT bonus_balance FROM users WHERE user_id = ?', (user_id,))
-            current = cur.fetchone()[0]
-            
-            if current >= amount:
-                cur.execute('''UPDATE users SET bonus_balance = bonus_balance - ? 
-                             WHERE user_id = ?''', (amount, user_id))
-                conn.commit()
-                return True
-            return False
-
     def create_re_auction(self, prize_id):
-        bonus_cost = int(self.get_setting('re_auction_bonus_cost'))
+        bonus_cost = self.get_setting('re_auction_bonus_cost')
+        duration = self.get_setting('re_auction_duration')
+        winners_count = self.get_winners_count(prize_id)
+        max_winners = self.get_setting('winners_per_prize')
         
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
-            winners_count = self.get_winners_count(prize_id)
-            max_winners = int(self.get_setting('winners_per_prize'))
-            
             if winners_count < max_winners:
                 cur = conn.cursor()
                 cur.execute('SELECT image FROM prizes WHERE prize_id = ?', (prize_id,))
                 image = cur.fetchone()[0]
                 
-                cur.execute('''INSERT INTO prizes (image, used) VALUES (?, 0)''', (image,))
+                cur.execute('''INSERT INTO prizes (image, used, deck_pos) VALUES (?, 0, ?)''',
+                            (image, self._deck_positions(cur, 1)[0]))
                 new_prize_id = cur.lastrowid
                 
                 start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                end_time = (datetime.now() + timedelta(minutes=int(self.get_setting('re_auction_duration')))).strftime('%Y-%m-%d %H:%M:%S')
+                end_time = (datetime.now() + timedelta(minutes=duration)).strftime('%Y-%m-%d %H:%M:%S')
                 
                 conn.execute('''INSERT INTO re_auctions (prize_id, original_prize_id, start_time, end_time, bonus_cost)
                               VALUES (?, ?, ?, ?, ?)''', (new_prize_id, prize_id, start_time, end_time, bonus_cost))
                 conn.commit()
                 
+                if self._re_auctions is not None:
+                    self._re_auctions.add((new_prize_id, prize_id, start_time, end_time, bonus_cost))
                 return new_prize_id
             return None
 
     def get_active_re_auctions(self):
         now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
             cur.execute('''SELECT * FROM re_auctions 
                           WHERE end_time > ?''', (now,))
             return cur.fetchall()
 
+    def get_re_auction_index(self):
+        if self._re_auctions is None:
+            with self._re_auctions_lock:
+                if self._re_auctions is None:
+                    index = ReAuctionIndex()
+                    for row in self.get_active_re_auctions():
+                        index.add(row)
+                    self._re_auctions = index
+        return self._re_auctions
+
+    def get_re_auction(self, prize_id):
+        return self.get_re_auction_index().get(prize_id)
+
+    def list_re_auctions(self):
+        return self.get_re_auction_index().active()
+
+    def expire_re_auctions(self):
+        return self.get_re_auction_index().expire()
+
     def get_winners_img(self, user_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
             cur.execute(''' 
@@ -216,106 +576,795 @@ class DatabaseManager:
             return [x[0] for x in cur.fetchall()]
 
     def get_users(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
-            cur.execute('SELECT user_id FROM users')
+            cur.execute('SELECT user_id FROM users WHERE blocked = 0')
             return [x[0] for x in cur.fetchall()] 
             
     def get_random_prize(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM prizes WHERE used = 0 ORDER BY RANDOM()')
-            rows = cur.fetchall()
-            return rows[0] if rows else None
+            cur.execute('''SELECT prize_id, image, used, added_by, added_date FROM prizes 
+                          WHERE used = 0 ORDER BY deck_pos LIMIT 1''')
+            return cur.fetchone()
         
     def get_prize_img(self, prize_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
             cur.execute('SELECT image FROM prizes WHERE prize_id = ?', (prize_id, ))
             return cur.fetchall()[0][0]
         
+    def get_file_id(self, image, variant):
+        conn = self.connect()
+        with conn:
+            cur = conn.cursor()
+            cur.execute('SELECT file_id FROM photo_files WHERE image = ? AND variant = ?', (image, variant))
+            result = cur.fetchone()
+            return result[0] if result else None
+
+    def set_file_id(self, image, variant, file_id):
+        conn = self.connect()
+        with conn:
+            conn.execute('''INSERT OR REPLACE INTO photo_files (image, variant, file_id) 
+                          VALUES (?, ?, ?)''', (image, variant, file_id))
+            conn.commit()
+
+    def clear_file_id(self, image, variant):
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM photo_files WHERE image = ? AND variant = ?', (image, variant))
+            conn.commit()
+
+    def get_hidden_hashes(self):
+        conn = self.connect()
+        with conn:
+            cur = conn.cursor()
+            cur.execute('SELECT image, content_hash, params FROM hidden_images')
+            return {x[0]: (x[1], x[2]) for x in cur.fetchall()}
+
+    def set_hidden_hashes(self, data):
+        conn = self.connect()
+        with conn:
+            conn.executemany('''INSERT OR REPLACE INTO hidden_images (image, content_hash, params) 
+                              VALUES (?, ?, ?)''', data)
+            conn.commit()
+
+    def enqueue_messages(self, chat_ids, image, caption, prize_id, is_re_auction=False):
+        now = time.time()
+        conn = self.connect()
+        with conn:
+            conn.executemany('''INSERT INTO outbox (chat_id, image, caption, prize_id, is_re_auction, next_attempt) 
+                              VALUES (?, ?, ?, ?, ?, ?)''',
+                             [(chat_id, image, caption, prize_id, int(is_re_auction), now) for chat_id in chat_ids])
+            conn.commit()
+
+    def fetch_outbox(self, limit, lease=OUTBOX_LEASE):
+        # Выбранные сообщения не удаляются, а откладываются на lease секунд:
+        # если процесс упадёт до подтверждения, они будут отправлены снова
+        now = time.time()
+        conn = self.connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cur = conn.cursor()
+            cur.execute('''SELECT id, chat_id, image, caption, prize_id, is_re_auction, attempts FROM outbox 
+                          WHERE status = 'pending' AND next_attempt <= ?
+                          ORDER BY next_attempt, id LIMIT ?''', (now, limit))
+            rows = cur.fetchall()
+            cur.executemany('UPDATE outbox SET next_attempt = ? WHERE id = ?',
+                            [(now + lease, row[0]) for row in rows])
+            return rows
+
+    def ack_outbox(self, ids):
+        conn = self.connect()
+        with conn:
+            conn.executemany('DELETE FROM outbox WHERE id = ?', [(x,) for x in ids])
+            conn.commit()
+
+    def retry_outbox(self, message_id, error, delay):
+        conn = self.connect()
+        with conn:
+            conn.execute('''UPDATE outbox SET attempts = attempts + 1, next_attempt = ?, last_error = ? 
+                          WHERE id = ?''', (time.time() + delay, error, message_id))
+            conn.commit()
+
+    def dead_letter_outbox(self, message_id, error):
+        conn = self.connect()
+        with conn:
+            # next_attempt у мёртвого сообщения — время, когда оно стало мёртвым
+            conn.execute('''UPDATE outbox SET status = 'dead', attempts = attempts + 1, last_error = ?, next_attempt = ? 
+                          WHERE id = ?''', (error, time.time(), message_id))
+            conn.commit()
+
+    def prune_outbox(self, ttl=OUTBOX_DEAD_TTL):
+        conn = self.connect()
+        with conn:
+            cur = conn.execute("DELETE FROM outbox WHERE status = 'dead' AND next_attempt < ?", (time.time() - ttl,))
+            conn.commit()
+            return cur.rowcount
+
+    def get_outbox_pending_count(self):
+        conn = self.connect()
+        with conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+            return cur.fetchone()[0]
+
     def get_winners_count(self, prize_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
             cur.execute('SELECT COUNT(*) FROM winners WHERE prize_id = ?', (prize_id, ))
             return cur.fetchall()[0][0]
 
     def mark_prize_used(self, prize_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             conn.execute('''UPDATE prizes SET used = 1 WHERE prize_id = ?''', (prize_id,))
             conn.commit()
 
     def reset_used_prizes(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
-            conn.execute('''UPDATE prizes SET used = 0''')
+            conn.execute('''UPDATE prizes SET used = 0, 
+                          deck_pos = abs(random()) / 9223372036854775808.0''')
             conn.commit()
 
     def get_rating(self):
-        conn = sqlite3.connect(self.database)
+        # Топ-10 кэшируется до следующего выигрыша или списания бонусов
+        with self._rating_lock:
+            rating, gen = self._rating, self._rating_gen
+        if rating is not None:
+            return rating
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
             cur.execute('''
-                SELECT users.user_name, COUNT(winners.prize_id) as count_prize, users.bonus_balance 
-                FROM winners
-                INNER JOIN users on users.user_id = winners.user_id
-                GROUP BY winners.user_id
-                ORDER BY count_prize DESC
+                SELECT user_name, win_count, bonus_balance 
+                FROM users
+                WHERE win_count > 0
+                ORDER BY win_count DESC
                 LIMIT 10
             ''')
-            return cur.fetchall()
+            rating = cur.fetchall()
+        with self._rating_lock:
+            if self._rating_gen == gen:
+                self._rating = rating
+        return rating
+
+    def _invalidate_rating(self):
+        with self._rating_lock:
+            self._rating_gen += 1
+            self._rating = None
+
+    def get_user_rank(self, user_id):
+        conn = self.connect()
+        with conn:
+            cur = conn.cursor()
+            cur.execute('SELECT win_count FROM users WHERE user_id = ?', (user_id,))
+            result = cur.fetchone()
+            if not result or not result[0]:
+                return None
+            cur.execute('SELECT COUNT(*) + 1 FROM users WHERE win_count > ?', (result[0],))
+            return cur.fetchone()[0]
 
     def get_all_prizes(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM prizes ORDER BY added_date DESC')
+            cur.execute('''SELECT prize_id, image, used, added_by, added_date FROM prizes 
+                          ORDER BY added_date DESC''')
             return cur.fetchall()
 
     def delete_prize(self, prize_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             conn.execute('DELETE FROM prizes WHERE prize_id = ?', (prize_id,))
             conn.commit()
 
-def hide_img(img_name):
+class UserRegistry:
+    # Зарегистрированные пользователи в памяти: множество для проверки
+    # и компактный массив id для рассылки порциями. Удалённые id остаются в
+    # массиве как tombstones и пропускаются при рассылке; массив сжимается,
+    # когда их больше половины. Сжатие создаёт новый массив, поэтому уже
+    # идущая рассылка дочитывает старый и не теряет пользователей
+    def __init__(self, user_ids=()):
+        self._lock = threading.Lock()
+        self._ids = array('q', user_ids)
+        self._set = set(self._ids)
+        self._tombstones = set()
+
+    def add(self, user_id):
+        with self._lock:
+            if user_id in self._tombstones:
+                self._tombstones.discard(user_id)
+                self._set.add(user_id)
+            elif user_id not in self._set:
+                self._set.add(user_id)
+                self._ids.append(user_id)
+
+    def discard(self, user_id):
+        with self._lock:
+            if user_id in self._set:
+                self._set.discard(user_id)
+                self._tombstones.add(user_id)
+                if len(self._tombstones) * 2 > len(self._ids):
+                    self._ids = array('q', (x for x in self._ids if x not in self._tombstones))
+                    self._tombstones = set()
+
+    def __contains__(self, user_id):
+        return user_id in self._set
+
+    def __len__(self):
+        return len(self._set)
+
+    def chunks(self, size):
+        with self._lock:
+            ids = self._ids
+            total = len(ids)
+        for start in range(0, total, size):
+            with self._lock:
+                chunk = [x for x in ids[start:min(start + size, total)] if x in self._set]
+            if chunk:
+                yield chunk
+
+class ReAuctionIndex:
+    # Активные повторные аукционы: словарь prize_id -> строка re_auctions
+    # и куча по времени окончания для снятия истёкших
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._auctions = {}
+        self._heap = []
+
+    def add(self, row):
+        end = datetime.strptime(row[3], '%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            self._auctions[row[0]] = (end, row)
+            heapq.heappush(self._heap, (end, row[0]))
+
+    def expire(self, now=None):
+        now = now or datetime.now()
+        expired = 0
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                end, prize_id = heapq.heappop(self._heap)
+                auction = self._auctions.get(prize_id)
+                if auction and auction[0] == end:
+                    del self._auctions[prize_id]
+                    expired += 1
+        return expired
+
+    def next_end(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def get(self, prize_id):
+        auction = self._auctions.get(prize_id)
+        if auction is None or auction[0] <= datetime.now():
+            return None
+        return auction[1]
+
+    def active(self):
+        self.expire()
+        with self._lock:
+            return [row for end, row in sorted(self._auctions.values())]
+
+class ClaimJournal:
+    # Выигрыши обычных лотов принимаются в памяти (лимит победителей и повторы
+    # проверяются здесь) и пишутся в БД пачками: раз в interval секунд или
+    # сразу по набору batch заявок. Победитель получает future, которое
+    # завершается, когда его выигрыш записан: True, или False, если выигрыш
+    # этого приза уже был в БД и бонус повторно не начислен
+    def __init__(self, manager, interval=CLAIM_FLUSH_INTERVAL, batch=CLAIM_FLUSH_BATCH, max_lots=64):
+        self.manager = manager
+        self.interval = interval
+        self.batch = batch
+        self.max_lots = max_lots
+        self._cond = threading.Condition()
+        self._lots = OrderedDict()
+        self._pending = []
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='claim-journal', daemon=True)
+        self._thread.start()
+
+    def _lot(self, prize_id):
+        lot = self._lots.get(prize_id)
+        if lot is None:
+            state = self.manager.get_lot_state(prize_id)
+            if state is None:
+                return None
+            lot = {'image': state[0], 'claimants': state[1], 'pending': 0, 'started': None}
+            self._lots[prize_id] = lot
+            for old_id in list(self._lots):
+                if len(self._lots) <= self.max_lots:
+                    break
+                if self._lots[old_id]['pending'] == 0:
+                    del self._lots[old_id]
+        self._lots.move_to_end(prize_id)
+        return lot
+
+    def start(self, prize_id):
+        with self._cond:
+            lot = self._lot(prize_id)
+            if lot is not None and lot['started'] is None:
+                lot['started'] = time.monotonic()
+
+    def claim(self, user_id, prize_id):
+        max_winners = self.manager.get_setting('winners_per_prize')
+        with self._cond:
+            lot = self._lot(prize_id)
+            if lot is None:
+                return CLAIM_SOLD_OUT, None, None
+            if user_id in lot['claimants']:
+                return CLAIM_ALREADY_WON, lot['image'], None
+            if len(lot['claimants']) >= max_winners:
+                return CLAIM_SOLD_OUT, lot['image'], None
+
+            lot['claimants'].add(user_id)
+            lot['pending'] += 1
+            if len(lot['claimants']) >= max_winners and lot['started'] is not None:
+                metrics.LOT_SOLD_OUT_SECONDS.observe(time.monotonic() - lot['started'])
+            durable = Future()
+            win_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            self._pending.append((user_id, prize_id, win_time, self.manager.get_setting('bonus_per_win'), durable))
+            self._cond.notify()
+            return CLAIM_WON, lot['image'], durable
+
+    def is_sold_out(self, prize_id):
+        with self._cond:
+            lot = self._lots.get(prize_id)
+            return lot is not None and len(lot['claimants']) >= self.manager.get_setting('winners_per_prize')
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                deadline = time.monotonic() + self.interval
+                while len(self._pending) < self.batch and not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, []
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            recorded = self.manager.record_wins([x[:4] for x in batch])
+            error = None
+        except Exception as e:
+            logger.exception('failed to record %d claims', len(batch))
+            recorded, error = [False] * len(batch), e
+
+        with self._cond:
+            for user_id, prize_id, win_time, bonus, durable in batch:
+                lot = self._lots.get(prize_id)
+                if lot is not None:
+                    lot['pending'] -= 1
+                    if error is not None:
+                        lot['claimants'].discard(user_id)
+        for x, ok in zip(batch, recorded):
+            if error is None:
+                x[4].set_result(ok)
+            else:
+                x[4].set_exception(error)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+def fit_size(image, side):
+    # Размер с большей стороной side и исходными пропорциями
+    height, width = image.shape[:2]
+    scale = side / max(height, width)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def encode_jpeg(image, quality):
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError('cannot encode image')
+    return encoded.tobytes()
+
+def write_atomic(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def pixelate(image):
+    # В скрытой версии всё равно только HIDE_BLOCKS x HIDE_BLOCKS блоков, поэтому
+    # она увеличивается лишь до HIDDEN_SIDE: крупные блоки в JPEG — пара КБ
+    blurred_image = cv2.GaussianBlur(image, (HIDE_BLUR, HIDE_BLUR), 0)
+    pixelated_image = cv2.resize(blurred_image, (HIDE_BLOCKS, HIDE_BLOCKS), interpolation=cv2.INTER_NEAREST)
+    return cv2.resize(pixelated_image, fit_size(image, HIDDEN_SIDE), interpolation=cv2.INTER_NEAREST)
+
+def hide_img(img_name, image=None):
+    # Файл сохраняет имя оригинала, но всегда записывается как JPEG:
+    # OpenCV и Telegram определяют формат по содержимому
+    if image is None:
+        image = cv2.imread(f'img/{img_name}')
+    write_atomic(f'hidden_img/{img_name}', encode_jpeg(pixelate(image), HIDDEN_JPEG_QUALITY))
+
+def encode_display(image):
+    # Версия для победителей: не больше DISPLAY_SIDE, как её всё равно покажет Telegram
+    if max(image.shape[:2]) > DISPLAY_SIDE:
+        image = cv2.resize(image, fit_size(image, DISPLAY_SIDE), interpolation=cv2.INTER_AREA)
+    return encode_jpeg(image, DISPLAY_JPEG_QUALITY)
+
+def shrink_img(img_name, image=None, size=None):
+    # Пишется в display_img/, только если уменьшенная версия меньше оригинала
+    if image is None:
+        image = cv2.imread(f'img/{img_name}')
+    if size is None:
+        size = os.path.getsize(f'img/{img_name}')
+    data = encode_display(image)
+    path = f'display_img/{img_name}'
+    if len(data) < size:
+        write_atomic(path, data)
+    elif os.path.exists(path):
+        os.remove(path)
+
+# make_variants и hide_img_timed выполняются в пуле процессов. Метрики
+# дочернего процесса не видны основному, поэтому длительность возвращается
+# и записывается вызывающим
+def make_variants(img_name):
+    # Обе версии за одно декодирование
+    started = time.perf_counter()
     image = cv2.imread(f'img/{img_name}')
-    blurred_image = cv2.GaussianBlur(image, (15, 15), 0)
-    pixelated_image = cv2.resize(blurred_image, (30, 30), interpolation=cv2.INTER_NEAREST)
-    pixelated_image = cv2.resize(pixelated_image, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
-    cv2.imwrite(f'hidden_img/{img_name}', pixelated_image)
-
-def create_collage(image_paths):
-    images = []
-    for path in image_paths:
-        image = cv2.imread(path)
-        images.append(image)
-
-    num_images = len(images)
+    hide_img(img_name, image)
+    shrink_img(img_name, image)
+    return time.perf_counter() - started
+
+def hide_img_timed(img_name):
+    started = time.perf_counter()
+    hide_img(img_name)
+    return time.perf_counter() - started
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def prepare_hidden_images(manager, pool, images=None):
+    # Скрытая и уменьшенная версии пересчитываются, только если изменился
+    # оригинал или параметры версий
+    if images is None:
+        images = os.listdir('img')
+    known = manager.get_hidden_hashes()
+
+    futures = {}
+    for img in images:
+        content_hash = file_hash(f'img/{img}')
+        if known.get(img) == (content_hash, HIDE_PARAMS) and os.path.exists(f'hidden_img/{img}'):
+            continue
+        futures[pool.submit(make_variants, img)] = (img, content_hash)
+
+    done = []
+    for future in as_completed(futures):
+        img, content_hash = futures[future]
+        try:
+            metrics.IMAGE_SECONDS.observe(future.result(), op='make_variants')
+        except Exception as e:
+            logger.warning('make_variants failed for %s: %s', img, e)
+            continue
+        manager.clear_file_id(img, 'hidden')
+        manager.clear_file_id(img, 'original')
+        done.append((img, content_hash, HIDE_PARAMS))
+
+    manager.set_hidden_hashes(done)
+    return len(done)
+
+def image_phash(image):
+    # dHash: 64 бита — светлее ли каждый пиксель соседа справа
+    # на уменьшенной до 9x8 серой картинке
+    gray = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return f'{int(np.packbits(bits).view(">u8")[0]):016x}'
+
+def inspect_image(task):
+    # Выполняется в пуле процессов: чтение, проверка, хэши и производные
+    # версии за одно декодирование. target — имя в img/; для новых файлов
+    # из другого каталога оно строится по хэшу содержимого
+    path, target, existing = task
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None or image.shape[0] == 0 or image.shape[1] == 0:
+            return path, target, existing, None, None, False, 'cannot decode'
+        content_hash = hashlib.sha1(data).hexdigest()
+        if target is None:
+            target = content_hash[:16] + os.path.splitext(path)[1].lower()
+        hidden_path = f'hidden_img/{target}'
+        hidden = not os.path.exists(hidden_path)
+        if hidden:
+            hide_img(target, image)
+            shrink_img(target, image, len(data))
+        return path, target, existing, content_hash, image_phash(image), hidden, None
+    except Exception as e:
+        return path, target, existing, None, None, False, str(e)
+
+class PhashIndex:
+    # Перцептивные хэши каталога; дубль — расстояние Хэмминга не больше distance
+    def __init__(self, hashes, capacity, distance=IMPORT_PHASH_DISTANCE):
+        self.distance = distance
+        self._hashes = np.zeros(max(1, len(hashes) + capacity), dtype=np.uint64)
+        self._size = 0
+        for value in hashes:
+            self.add(value)
+
+    def add(self, value):
+        self._hashes[self._size] = np.uint64(int(value, 16))
+        self._size += 1
+
+    def __contains__(self, value):
+        if not self._size:
+            return False
+        diff = self._hashes[:self._size] ^ np.uint64(int(value, 16))
+        # np.bitwise_count есть только в NumPy 2, биты считаются через unpackbits
+        distances = np.unpackbits(diff.view(np.uint8)).reshape(-1, 64).sum(1)
+        return bool((distances <= self.distance).any())
+
+def normalize_upload(path, max_side=UPLOAD_MAX_SIDE, quality=UPLOAD_JPEG_QUALITY):
+    # Выполняется в пуле процессов: загруженный файл уменьшается до max_side
+    # по большей стороне и перекодируется в JPEG; рядом пишутся скрытая версия
+    # и, если она легче оригинала, уменьшенная для показа. Возвращает имя приза
+    # по хэшу содержимого, хэши и пути готовых файлов (display_path может быть None)
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('cannot decode image')
+    if max(image.shape[:2]) > max_side:
+        image = cv2.resize(image, fit_size(image, max_side), interpolation=cv2.INTER_AREA)
+    data = encode_jpeg(image, quality)
+    content_hash = hashlib.sha1(data).hexdigest()
+
+    original_path, hidden_path = f'{path}.jpg', f'{path}.hidden.jpg'
+    with open(original_path, 'wb') as f:
+        f.write(data)
+    with open(hidden_path, 'wb') as f:
+        f.write(encode_jpeg(pixelate(image), HIDDEN_JPEG_QUALITY))
+    display_path = None
+    display = encode_display(image)
+    if len(display) < len(data):
+        display_path = f'{path}.display.jpg'
+        with open(display_path, 'wb') as f:
+            f.write(display)
+    return (f'prize_{content_hash[:16]}.jpg', content_hash, image_phash(image),
+            original_path, hidden_path, display_path)
+
+def copy_atomic(source, destination):
+    tmp_path = f'{destination}.tmp'
+    shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+def import_prizes(manager, pool, source='img', added_by=None, chunksize=16):
+    # Массовый импорт: файлы, уже известные каталогу по имени и хэшу, не
+    # читаются; остальные проверяются в пуле, дубли по хэшу содержимого
+    # или перцептивному хэшу пропускаются, новые призы добавляются одной
+    # транзакцией. Для старых записей без хэшей хэши досчитываются. Дубли,
+    # найденные прямо в img/, переносятся в duplicates/: /get_my_score строит
+    # коллекцию по содержимому img/
+    for directory in ('img', 'hidden_img', 'display_img'):
+        os.makedirs(directory, exist_ok=True)
+    catalog = manager.get_prize_hashes()
+    in_place = os.path.abspath(source) == os.path.abspath('img')
+
+    known = {content_hash for content_hash, _ in catalog.values() if content_hash}
+    stats = {'scanned': 0, 'added': 0, 'duplicates': 0, 'invalid': 0, 'backfilled': 0}
+
+    tasks = [(f'img/{image}', image, True) for image, (content_hash, _) in catalog.items()
+             if content_hash is None and os.path.exists(f'img/{image}')]
+    for name in sorted(os.listdir(source)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        stats['scanned'] += 1
+        path = os.path.join(source, name)
+        if in_place:
+            if name not in catalog:
+                tasks.append((path, name, False))
+        elif file_hash(path) in known:
+            # Точная копия уже известной картинки — декодировать незачем
+            stats['duplicates'] += 1
+        else:
+            tasks.append((path, None, False))
+
+    phashes = PhashIndex([phash for _, phash in catalog.values() if phash], len(tasks))
+    new, backfill, hidden_done = [], [], []
+
+    for path, target, existing, content_hash, phash, hidden, error in pool.map(inspect_image, tasks, chunksize=chunksize):
+        if error is not None:
+            logger.warning('skipping %s: %s', path, error)
+            stats['invalid'] += 1
+            continue
+        if existing:
+            backfill.append((content_hash, phash, target))
+        elif content_hash in known or phash in phashes or target in catalog:
+            stats['duplicates'] += 1
+            if hidden and target not in catalog:
+                for variant in (f'hidden_img/{target}', f'display_img/{target}'):
+                    if os.path.exists(variant):
+                        os.remove(variant)
+            if in_place and target not in catalog:
+                os.makedirs('duplicates', exist_ok=True)
+                os.replace(path, os.path.join('duplicates', target))
+                logger.info('moved duplicate %s to duplicates/', target)
+            continue
+        else:
+            if not in_place:
+                copy_atomic(path, f'img/{target}')
+            new.append((target, content_hash, phash))
+            catalog[target] = (content_hash, phash)
+        known.add(content_hash)
+        phashes.add(phash)
+        if hidden:
+            hidden_done.append((target, content_hash, HIDE_PARAMS))
+
+    manager.add_prize(new, added_by)
+    manager.set_prize_hashes(backfill)
+    manager.set_hidden_hashes(hidden_done)
+    stats['added'] = len(new)
+    stats['backfilled'] = len(backfill)
+    return stats
+
+def fit_tile(image, tile_size):
+    return cv2.resize(image, (tile_size, tile_size), interpolation=cv2.INTER_AREA)
+
+def tile_collage(tiles, num_images, tile_size):
     num_cols = floor(sqrt(num_images))
     if num_cols == 0:
         num_cols = 1
     num_rows = ceil(num_images/num_cols)
     
-    collage = np.zeros((num_rows * images[0].shape[0], num_cols * images[0].shape[1], 3), dtype=np.uint8)
+    collage = np.zeros((num_rows * tile_size, num_cols * tile_size, 3), dtype=np.uint8)
     
-    for i, image in enumerate(images):
+    for i, tile in enumerate(tiles):
         row = i // num_cols
         col = i % num_cols
-        collage[row*image.shape[0]:(row+1)*image.shape[0], col*image.shape[1]:(col+1)*image.shape[1], :] = image
+        collage[row*tile_size:(row+1)*tile_size, col*tile_size:(col+1)*tile_size, :] = tile
     
     return collage
 
+class ByteLRU:
+    # LRU с бюджетом в байтах. Запись действительна, пока совпадает stamp
+    # (например, mtime и размер файла); name — метка в метриках попаданий
+    def __init__(self, max_bytes, name):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.size = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._hits = metrics.CACHE_REQUESTS.labels(cache=name, result='hit')
+        self._misses = metrics.CACHE_REQUESTS.labels(cache=name, result='miss')
+
+    def get(self, key, stamp):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != stamp:
+                self._misses.inc()
+                return None
+            self._items.move_to_end(key)
+        self._hits.inc()
+        return item[1]
+
+    def put(self, key, stamp, value, size):
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._items[key] = (stamp, value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self._items.popitem(last=False)
+                self.size -= evicted
+        return value
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+class ImageCache:
+    # Файлы картинок в памяти: текущий лот читается с диска один раз, а не на
+    # каждого получателя. Файлы от mmap_threshold байт отображаются в память
+    # вместо чтения в буфер
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES, mmap_threshold=IMAGE_MMAP_THRESHOLD):
+        self.mmap_threshold = mmap_threshold
+        self._cache = ByteLRU(max_bytes, 'image_bytes')
+
+    def load(self, path, size=None):
+        # Без кэширования: bytes или memoryview поверх mmap
+        if size is None:
+            size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if size < self.mmap_threshold:
+                return f.read()
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def read(self, path):
+        stamp = file_stamp(path)
+        data = self._cache.get(path, stamp)
+        if data is None:
+            data = self._cache.put(path, stamp, self.load(path, stamp[1]), stamp[1])
+        return data
+
+    def decode(self, path):
+        return cv2.imdecode(np.frombuffer(self.load(path), np.uint8), cv2.IMREAD_COLOR)
+
+class CollageCache:
+    # Миниатюры картинок и готовые коллекции пользователей, оба кэша с
+    # бюджетом в байтах. Версия коллекции меняется только при выигрыше
+    # (invalidate) или изменении каталога. Большая коллекция делится на
+    # страницы по page_size клеток
+    def __init__(self, tile_size=TILE_SIZE, page_size=COLLAGE_PAGE_SIZE, files=None,
+                 tile_bytes=TILE_CACHE_BYTES, collage_bytes=COLLAGE_CACHE_BYTES):
+        self.tile_size = tile_size
+        self.page_size = page_size
+        self.files = files or ImageCache()
+        self._lock = threading.Lock()
+        self._tiles = ByteLRU(tile_bytes, 'tiles')
+        self._versions = {}
+        self._collages = ByteLRU(collage_bytes, 'collages')
+
+    def tile(self, img, hidden):
+        if hidden:
+            path = f'hidden_img/{img}'
+            if not os.path.exists(path):
+                metrics.IMAGE_SECONDS.observe(hide_img_timed(img), op='hide_img')
+        else:
+            # Уменьшенную версию декодировать дешевле оригинала
+            path = f'display_img/{img}'
+            if not os.path.exists(path):
+                path = f'img/{img}'
+        stamp = (path, file_stamp(path))
+        tile = self._tiles.get((img, hidden), stamp)
+        if tile is None:
+            tile = fit_tile(self.files.decode(path), self.tile_size)
+            self._tiles.put((img, hidden), stamp, tile, tile.nbytes)
+        return tile
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def get(self, user_id, images, load_won):
+        with self._lock:
+            key = (self._versions.get(user_id, 0), tuple(images))
+        cached = self._collages.get(user_id, key)
+        if cached is not None:
+            return cached
+
+        won_prizes = load_won()
+        won = set(won_prizes)
+        pages = []
+        for start in range(0, len(images), self.page_size):
+            page = images[start:start + self.page_size]
+            with metrics.IMAGE_SECONDS.time(op='collage_page'):
+                tiles = (self.tile(img, img not in won) for img in page)
+                collage = tile_collage(tiles, len(page), self.tile_size)
+                pages.append(cv2.imencode('.jpg', collage)[1].tobytes())
+
+        return self._collages.put(user_id, key, (len(won_prizes), pages), sum(len(page) for page in pages))
+
 if __name__ == '__main__':
+    # python logic.py [каталог] — импорт картинок в каталог призов (по умолчанию img/)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     manager = DatabaseManager(DATABASE)
     manager.create_tables()
-    
-    if os.path.exists('img'):
-        prizes_img = os.listdir('img')
-        data = [(x,) for x in prizes_img]
-        manager.add_prize(data)
\ No newline at end of file
+
+    source = sys.argv[1] if len(sys.argv) > 1 else 'img'
+    if os.path.isdir(source):
+        started = time.monotonic()
+        with ProcessPoolExecutor(IMAGE_WORKERS, mp_context=get_context('spawn')) as pool:
+            stats = import_prizes(manager, pool, source)
+        logger.info('imported %s from %s in %.1f s: %s', stats['added'], source, time.monotonic() - started, stats)
+    manager.close()
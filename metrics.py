@@ -0,0 +1,212 @@
+import bisect
+import functools
+import inspect
+import os
+import threading
+import time
+
+# Метрики в памяти процесса в текстовом формате Prometheus. Запись в
+# серию — бинарный поиск корзины и короткая блокировка, поэтому счётчики
+# можно держать включёнными постоянно. Снимок отдаётся по /metrics
+# (runtime.py, режим вебхука) и периодически пишется в METRICS_FILE
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_registry = []
+
+def _format_labels(items):
+    if not items:
+        return ''
+    escaped = ((k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class _Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+class _Timer:
+    __slots__ = ('series', 'started')
+
+    def __init__(self, series):
+        self.series = series
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.series.observe(time.perf_counter() - self.started)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _new_series(self):
+        return _Value()
+
+    def labels(self, **labels):
+        key = tuple(labels.items())
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(key, self._new_series())
+        return series
+
+    def _samples(self):
+        for key, series in list(self._series.items()):
+            yield self.name, key, series.value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+        for name, key, value in self._samples():
+            lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+class Gauge(Metric):
+    # func вызывается при каждом снимке — для значений, которые дешевле
+    # прочитать по запросу, чем поддерживать на каждом изменении
+    kind = 'gauge'
+
+    def __init__(self, name, doc, func=None):
+        super().__init__(name, doc)
+        self.func = func
+
+    def set(self, value, **labels):
+        self.labels(**labels).set(value)
+
+    def _samples(self):
+        if self.func is not None:
+            yield self.name, (), self.func()
+        yield from super()._samples()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc)
+        self.buckets = tuple(buckets)
+
+    def _new_series(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    def time(self, **labels):
+        return self.labels(**labels).time()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+        for key, series in list(self._series.items()):
+            with series.lock:
+                counts, total, count = list(series.counts), series.sum, series.count
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(key + (("le", le),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+def timed(histogram, **labels):
+    def decorator(func):
+        series = histogram.labels(**labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                series.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+def instrumented(histogram, label='method', skip=()):
+    # Декоратор класса: время каждого публичного метода попадает в histogram
+    # с меткой label=<имя метода>. Генераторы пропускаются — их работа идёт
+    # уже после возврата из вызова
+    def decorator(cls):
+        for name, func in list(vars(cls).items()):
+            if (name.startswith('_') or name in skip or not inspect.isfunction(func)
+                    or inspect.isgeneratorfunction(func)):
+                continue
+            setattr(cls, name, timed(histogram, **{label: name})(func))
+        return cls
+    return decorator
+
+def render():
+    lines = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            lines.append(f'# {metric.name} unavailable: {e}')
+    return '\n'.join(lines) + '\n'
+
+def dump(path):
+    # Через временный файл, чтобы сборщик не прочитал половину снимка
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+HANDLER_SECONDS = Histogram('auction_handler_seconds', 'Time spent in bot handlers')
+DB_SECONDS = Histogram('auction_db_seconds', 'Time spent in DatabaseManager methods')
+IMAGE_SECONDS = Histogram('auction_image_seconds', 'Time spent processing images')
+BROADCAST_SECONDS = Histogram('auction_broadcast_seconds', 'Duration of a broadcast run')
+BROADCAST_MESSAGES = Counter('auction_broadcast_messages_total', 'Broadcast deliveries by result')
+BROADCAST_THROTTLED = Counter('auction_broadcast_throttled_total', 'Telegram 429 responses during broadcasts')
+BROADCAST_PROGRESS = Gauge('auction_broadcast_progress', 'Deliveries finished in the current broadcast run')
+BROADCAST_TOTAL = Gauge('auction_broadcast_total', 'Deliveries planned in the current broadcast run')
+LOT_SOLD_OUT_SECONDS = Histogram('auction_lot_sold_out_seconds', 'Time from a lot being sent to its last winner')
+CACHE_REQUESTS = Counter('auction_cache_requests_total', 'In-memory cache lookups by result')
+OUTBOX_PENDING = Gauge('auction_outbox_pending', 'Messages waiting in the outbox')
+REAUCTION_SENDS_SAVED = Counter('auction_reauction_sends_saved_total', 'Re-auction sends skipped for users without enough bonuses')
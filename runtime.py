@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Update
+import bot as handlers
+import metrics
+from config import *
+
+logger = logging.getLogger(__name__)
+
+# Асинхронный рантайм: обновления принимаются через async API telebot
+# (long polling или вебхук), а синхронные обработчики из bot.py вместе
+# с работой с БД и OpenCV выполняются в пуле потоков, не больше
+# HANDLER_CONCURRENCY одновременно
+
+class Runtime:
+    def __init__(self, concurrency=HANDLER_CONCURRENCY):
+        if API_URL:
+            asyncio_helper.API_URL = API_URL
+        self.api = AsyncTeleBot(API_TOKEN)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='handler')
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        # Обработчики вызываются прямо в потоке пула, без собственного пула TeleBot
+        handlers.bot.threaded = False
+
+    async def dispatch(self, update):
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(self.executor, handlers.bot.process_new_updates, [update])
+            except Exception:
+                logger.exception('handler failed for update %s', update.update_id)
+
+    def submit(self, update):
+        task = asyncio.create_task(self.dispatch(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def poll(self):
+        await self.api.delete_webhook()
+        offset = None
+        while True:
+            try:
+                updates = await self.api.get_updates(offset=offset, timeout=POLLING_TIMEOUT)
+            except Exception:
+                logger.exception('getUpdates failed')
+                await asyncio.sleep(3)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.submit(update)
+
+    async def handle_webhook(self, request):
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        update = Update.de_json(await request.text())
+        if update is not None:
+            self.submit(update)
+        return web.Response()
+
+    async def handle_metrics(self, request):
+        # Снимок может обращаться к БД (длина очереди), поэтому не в цикле событий
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(self.executor, metrics.render)
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_webhook)
+        app.router.add_get('/metrics', self.handle_metrics)
+        return app
+
+    async def serve_webhook(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        await self.api.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+        logger.info('webhook listening on %s:%s%s', host, port, WEBHOOK_PATH)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def run(self, mode='polling'):
+        try:
+            if mode == 'webhook':
+                await self.serve_webhook()
+            else:
+                await self.poll()
+        finally:
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.api.close_session()
+            self.executor.shutdown(wait=True)
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'polling'
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers.init()
+    handlers.start_workers()
+
+    try:
+        asyncio.run(Runtime().run(mode))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        handlers.shutdown()
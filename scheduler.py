@@ -0,0 +1,136 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import SCHEDULER_WORKERS
+
+logger = logging.getLogger(__name__)
+
+class Job:
+    def __init__(self, name, func, interval=None, on_schedule=None, expect_overlap=False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.on_schedule = on_schedule
+        # Для задач, которые сами работают дольше интервала (разбор очереди),
+        # пропуск слота — норма и пишется в debug, а не в warning
+        self.expect_overlap = expect_overlap
+        self.when = None
+        self.last = None
+        self.running = False
+        self.cancelled = False
+
+class Scheduler:
+    # Куча таймеров: поток планировщика спит до ближайшего события и отдаёт
+    # задачу в пул, поэтому долгая рассылка не задерживает другие события.
+    # Периодические задачи идут по фиксированной сетке от запланированного
+    # времени; пропущенные слоты не догоняются, а одна задача не запускается
+    # повторно, пока не закончился предыдущий запуск
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scheduler')
+        self._heap = []
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def every(self, name, interval, func, first=None, on_schedule=None, expect_overlap=False):
+        if interval <= 0:
+            raise ValueError(f'interval for {name} must be positive, got {interval}')
+        job = Job(name, func, interval, on_schedule, expect_overlap)
+        self._schedule(job, time.time() + interval if first is None else first)
+        return job
+
+    def at(self, name, when, func):
+        job = Job(name, func)
+        self._schedule(job, when)
+        return job
+
+    def set_interval(self, name, interval):
+        if interval <= 0:
+            raise ValueError(f'interval for {name} must be positive, got {interval}')
+        with self._cond:
+            job = self._jobs.get(name)
+            if job is None or job.interval is None:
+                return
+            job.interval = interval
+            base = job.last if job.last is not None else time.time()
+        self._schedule(job, max(base + interval, time.time()))
+
+    def _schedule(self, job, when):
+        with self._cond:
+            old = self._jobs.get(job.name)
+            if old is not None and old is not job:
+                old.cancelled = True
+            self._jobs[job.name] = job
+            job.when = when
+            heapq.heappush(self._heap, (when, next(self._seq), job))
+            self._cond.notify()
+        # on_schedule пишет в БД; его сбой не должен мешать запуску задачи
+        if job.on_schedule:
+            try:
+                job.on_schedule(when)
+            except Exception:
+                logger.exception('on_schedule failed for job %s', job.name)
+
+    def _next_slot(self, job, when, now):
+        skipped = int((now - when) // job.interval)
+        return when + job.interval * (skipped + 1)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if self._stopped:
+                    return
+                when, _, job = heapq.heappop(self._heap)
+                if job.cancelled or when != job.when:
+                    continue
+                job.last = when
+                if job.interval is None:
+                    del self._jobs[job.name]
+
+            # Ошибка при перепланировании не должна остановить цикл или
+            # отменить запуск, слот которого уже наступил
+            if job.interval is not None:
+                try:
+                    self._schedule(job, self._next_slot(job, when, time.time()))
+                except Exception:
+                    logger.exception('failed to reschedule job %s', job.name)
+            try:
+                self._dispatch(job)
+            except Exception:
+                logger.exception('failed to dispatch job %s', job.name)
+
+    def _dispatch(self, job):
+        with self._cond:
+            if job.running:
+                logger.log(logging.DEBUG if job.expect_overlap else logging.WARNING,
+                           '%s is still running, slot skipped', job.name)
+                return
+            job.running = True
+        self.executor.submit(self._run_job, job)
+
+    def _run_job(self, job):
+        try:
+            job.func()
+        except Exception:
+            logger.exception('scheduled job %s failed', job.name)
+        finally:
+            with self._cond:
+                job.running = False
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self.executor.shutdown(wait=False)